@@ -0,0 +1,341 @@
+import asyncio
+import collections
+import ssl
+import time
+
+from urllib.parse import urlencode, urlsplit
+
+from .api import Salt, Error, TimedOut, NetworkError, Redacted, \
+    TransportResponse, RETRYABLE_REQUESTS, USER_AGENT
+
+
+class ConnectionPool(object):
+    """ A bounded pool of keep-alive HTTP/1.1 connections for asyncio.
+
+    At most ``size`` connections are open (or being opened) at once across
+    every endpoint; callers beyond that wait for a free slot. Idle connections
+    are kept per (scheme, host, port) for ``idle_timeout`` seconds and reused
+    by the next request to the same endpoint.
+
+    A single pool can be shared by any number of AsyncSalt clients.
+    """
+
+    def __init__(self, size=10, idle_timeout=30.0, connect_timeout=10.0,
+        ssl_context=None):
+        if size < 1: raise Error('Pool size must be at least 1')
+
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.ssl_context = ssl_context
+        self._slots = None
+        self._idle = collections.defaultdict(collections.deque)
+        self.opened = 0
+        self.reused = 0
+
+    def _get_slots(self):
+        # created lazily so the pool binds to the running loop, not to
+        # whichever loop happened to exist at construction time
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.size)
+        return self._slots
+
+    async def _connect(self, key):
+        scheme, host, port = key
+        context = None
+        if scheme == 'https':
+            context = self.ssl_context or ssl.create_default_context()
+
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port, ssl=context),
+                self.connect_timeout)
+        except asyncio.TimeoutError:
+            raise TimedOut('Timed out connecting to %s:%s' % (host, port))
+        except OSError as e:
+            raise NetworkError('Unable to connect to %s:%s: %s' % (
+                host, port, e))
+
+        self.opened += 1
+        return reader, writer
+
+    def _checkout_idle(self, key):
+        idle = self._idle[key]
+        now = time.monotonic()
+        while idle:
+            reader, writer, since = idle.pop()
+            if now - since < self.idle_timeout and not reader.at_eof() and \
+                not writer.is_closing():
+                return reader, writer
+            writer.close()
+        return None
+
+    def _checkin(self, key, conn):
+        reader, writer = conn
+        self._idle[key].append((reader, writer, time.monotonic()))
+
+    async def post(self, url, body, headers=None, timeout=None):
+        """ POST a form-encoded ``body`` to ``url``.
+
+        Returns a TransportResponse, like the transports of Salt. Raises
+        TimedOut when ``timeout`` seconds pass without a complete response
+        and NetworkError when the connection fails.
+        """
+
+        parts = urlsplit(url)
+        scheme = parts.scheme or 'http'
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        lines = [
+            'POST %s HTTP/1.1' % path,
+            'Host: %s' % parts.netloc,
+            'Content-Type: application/x-www-form-urlencoded',
+            'Content-Length: %d' % len(body),
+            'Connection: keep-alive',
+        ]
+        for name, value in (headers or {}).items():
+            lines.append('%s: %s' % (name, value))
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+        try:
+            status, content, remote_addr, reused = await asyncio.wait_for(
+                self._send(key, request), timeout)
+        except asyncio.TimeoutError:
+            raise TimedOut('No response from %s within %ss' % (url, timeout))
+        return TransportResponse(status, content, remote_addr, len(body),
+            reused)
+
+    async def _send(self, key, request):
+        async with self._get_slots():
+            return await self._send_on_slot(key, request)
+
+    async def _send_on_slot(self, key, request):
+        conn = self._checkout_idle(key)
+        if conn is not None:
+            self.reused += 1
+            try:
+                return await self._exchange(key, conn, request) + (True,)
+            except _StaleConnection:
+                # closed before a byte of the request was written, so the
+                # gateway can't have seen it; send it on a fresh connection
+                pass
+
+        conn = await self._connect(key)
+        try:
+            return await self._exchange(key, conn, request) + (False,)
+        except _StaleConnection:
+            raise NetworkError('Connection closed by %s:%s' % key[1:])
+
+    async def _exchange(self, key, conn, request):
+        reader, writer = conn
+        keep = False
+        try:
+            if reader.at_eof() or writer.is_closing():
+                raise _StaleConnection()
+
+            # from here on the gateway may have read and acted on the
+            # request, even if the connection then drops without a reply:
+            # never resend here; AsyncSalt resends only RETRYABLE_REQUESTS
+            try:
+                writer.write(request)
+                await writer.drain()
+                status_line = await reader.readline()
+            except (ConnectionError, OSError) as e:
+                raise NetworkError('Connection to %s:%s lost after sending '
+                    'the request: %s' % (key[1], key[2], e))
+            if not status_line:
+                raise NetworkError('Connection to %s:%s closed after sending '
+                    'the request' % key[1:])
+
+            try:
+                status, body, keep = await _read_response(status_line, reader)
+            except (ConnectionError, OSError, asyncio.IncompleteReadError,
+                ValueError) as e:
+                raise NetworkError('Bad response from %s:%s: %s' % (
+                    key[1], key[2], e))
+
+            remote_addr = writer.get_extra_info('peername') or (None, None)
+            return status, body, remote_addr[:2]
+        finally:
+            # anything short of a clean, complete response leaves the stream
+            # in an unknown state, including cancellation by a timeout
+            if keep:
+                self._checkin(key, conn)
+            else:
+                writer.close()
+
+    async def close(self):
+        """ Close every idle connection """
+
+        for idle in self._idle.values():
+            while idle:
+                reader, writer, since = idle.pop()
+                writer.close()
+
+
+class _StaleConnection(Exception): pass
+
+
+async def _read_response(status_line, reader):
+    version, status = status_line.decode('latin-1').split(None, 2)[:2]
+    status = int(status)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    keep = version == 'HTTP/1.1' and \
+        headers.get('connection', '').lower() != 'close'
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await reader.readline()
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b''.join(chunks)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()
+        keep = False
+
+    return status, body, keep
+
+
+class AsyncSalt(Salt):
+    """ asyncio version of the Salt client.
+
+    Every operation of Salt, SecureStorage and RecurringPurchase is available
+    with the same arguments but returns a coroutine:
+
+        async with AsyncSalt(apikey, merchant_id) as salt:
+            receipt = await salt.single_purchase(100, 'order-1',
+                credit_card_number=4242424242424242, expiry_date=1812)
+
+    Requests go out over a bounded keep-alive ConnectionPool, which may be
+    passed in to share sockets between several clients. Given a RetryPolicy,
+    requests in RETRYABLE_REQUESTS are resent after its backoff; purchases
+    and refunds are never resent, as there is no reconciliation here.
+    """
+
+    def __init__(self, apikey=None, merchant_id=None, url=None, debug=False,
+        pool=None, pool_size=10, timeout=30.0, instruments=(), retry=None):
+        """ initialize the API client
+
+        Args:
+            apikey (str): provide your Salt API key, required
+            merchant_id (str): provide your Salt Merchat ID, required
+            debug (bool): set True to log to "salt_api" logger at INFO level
+
+        Optional Args:
+            pool (ConnectionPool): share an existing pool between clients
+            pool_size (int): connection limit when creating our own pool,
+                defaults to 10
+            timeout (float): seconds allowed for each call, defaults to 30
+            instruments (list): Instrument hooks run around every request
+            retry (RetryPolicy): resend verifications that failed without
+                an answer, see above; no retries by default
+        """
+
+        self._owns_pool = pool is None
+        self.pool = pool if pool is not None else ConnectionPool(pool_size)
+        Salt.__init__(self, apikey, merchant_id, url, debug, retry=retry,
+            instruments=instruments, transport=self.pool)
+        self.timeout = timeout
+
+    async def call(self, params=None, timeout=None):
+        """ Actually make the API call with the given params """
+
+        retry = self.retry
+        request_code = (params or {}).get('requestCode')
+        if retry is None or request_code not in RETRYABLE_REQUESTS:
+            return await self._call_once(params, timeout)
+
+        if timeout is None:
+            timeout = self.timeout
+        give_up = time.time() + retry.deadline
+        attempt = 1
+        while True:
+            remaining = give_up - time.time()
+            try:
+                return await self._call_once(params, remaining
+                    if timeout is None else min(timeout, remaining))
+            except retry.retry_on as e:
+                error = e
+
+            if attempt >= retry.attempts:
+                raise error
+            wait = retry.delay(attempt)
+            if time.time() + wait >= give_up:
+                raise error
+
+            attempt += 1
+            self.log('Retrying %s in %.2fs after %r', request_code, wait,
+                error)
+            await asyncio.sleep(wait)
+
+    async def _call_once(self, params=None, timeout=None):
+        params = self._prepare(params)
+        body = urlencode(params).encode('ascii')
+        info = self._start_call(params) if self.instruments else None
+
+        endpoint = self.endpoint
+        log = self._log_call()
+        if log:
+            self.log('POST to %s: %s', endpoint, Redacted(params), extra={
+                'salt_event': 'request',
+                'salt_request_code': params.get('requestCode')})
+        start = time.time()
+        try:
+            response = await self.pool.post(
+                endpoint,
+                body,
+                headers={'User-Agent': USER_AGENT},
+                timeout=timeout if timeout is not None else self.timeout)
+        except Error as e:
+            if info is not None:
+                self._fail_call(info, e)
+            raise
+
+        if info is not None:
+            info.bytes_sent = response.bytes_sent
+            info.connection_reused = response.reused
+
+        return self._handle_response(params, response.status_code,
+            response.content, response.remote_addr, start, info, log)
+
+    def submit_many(self, requests, max_in_flight=10):
+        raise Error('AsyncSalt has no submit_many(), gather its coroutines '
+            'with asyncio instead')
+
+    def warm(self, connections=1):
+        raise Error('AsyncSalt connections are opened by the first calls, '
+            'there is no warm()')
+
+    async def close(self):
+        """ Close the pool's idle connections if this client created it """
+
+        if self._owns_pool:
+            await self.pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __repr__(self):
+        return '<AsyncSaltAPI %s - %s>' % (self.apikey, self.merchant_id)
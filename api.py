@@ -1,17 +1,68 @@
+import collections
+import collections.abc
+import contextvars
+import json
 import logging
-import requests
+import os
+import random
+import re
 import time
 import sys
+import threading
+import weakref
+
+from urllib.parse import parse_qsl, urlencode
+
+# requests, and concurrent.futures for the bulk helpers, are only imported
+# when first needed: short-lived processes that never reach the gateway
+# through them shouldn't pay for it on every start
 
 logger = logging.getLogger('salt_api')
 logger.setLevel(logging.INFO)
-logger.addHandler(logging.StreamHandler(sys.stderr))
+# the stderr handler is attached by the first record a client logs, see
+# _default_handler()
+_handler_lock = threading.Lock()
+_handler = None
+
+def _default_handler():
+    """ Attach the stderr handler to the salt_api logger, once, unless the
+    application gave the logger handlers of its own first
+    """
+
+    global _handler
+    with _handler_lock:
+        if _handler is None:
+            _handler = logging.StreamHandler(sys.stderr)
+            if not logger.handlers:
+                logger.addHandler(_handler)
 
 VERSION = '0.0.1'
+USER_AGENT = 'SaltTechnologiesAPI-Python/%s' % VERSION
+_HEADERS = {
+    'User-Agent': USER_AGENT,
+    'Content-Type': 'application/x-www-form-urlencoded',
+}
 
 ROOT = 'https://test.salt.com/gateway/creditcard/processor.do'
 
-class Error(Exception): pass
+class Error(Exception):
+    """ Base of every exception the client raises.
+
+    Errors the gateway answered with carry its reply as ``receipt``, which
+    is None for errors raised on our side. ``kind`` and the flags copied
+    from it (retryable, fraud, card, merchant_config) are set per class from
+    ERROR_CATEGORIES, so callers can branch on them without matching codes.
+    """
+
+    def __init__(self, *args, receipt=None):
+        Exception.__init__(self, *args)
+        self.receipt = receipt
+
+    @property
+    def code(self):
+        """ ERROR_MAP code, or the class name if there isn't one """
+        return _error_code(self)
+
 class TimedOut(Error): pass
 class SaltSystemError(Error): pass
 class NetworkError(Error): pass
@@ -49,6 +100,8 @@ class NoCreditCardInStorageRecord(Error): pass
 class DeclinedFromFraudProvider(Error): pass
 class ApprovedFromFraudProvider(Error): pass
 class ReviewFromFraudProvider(Error): pass
+class CircuitOpen(Error): pass
+class Overloaded(Error): pass
 
 ERROR_MAP = {
     'C001_TIMED_OUT': TimedOut,
@@ -91,38 +144,1597 @@ ERROR_MAP = {
     'C402_REVIEW_FROM_FRAUD_PROVIDER': ReviewFromFraudProvider,
 }
 
-def _get_cc_or_id(kwargs):
-    credit_card_number = kwargs.get('credit_card_number', None)
-    expiry_date = kwargs.get('expiry_date', None)
-    storage_token_id = kwargs.get('storage_token_id', None)
+# what each gateway error is about
+ERROR_CATEGORIES = {
+    # the gateway failed to give an answer
+    'gateway': ('C001_TIMED_OUT', 'C002_SYSTEM_ERROR', 'C003_NETWORK_ERROR'),
+    # credentials, limits and rates set up for the merchant account
+    'merchant_config': ('C100_INVALID_MERCHANT_CREDENTIALS',
+        'C107_REQUEST_DENIED', 'C110_TRANSACTION_EXCEEDS_ACCOUNT_LIMITS'),
+    # the request itself, or the transaction it refers to
+    'request': ('C004_VALIDATION_ERROR', 'C101_AMOUNT_OUT_OF_BOUNDS',
+        'C102_INVALID_PURCHASE', 'C103_INVALID_TRANSACTION',
+        'C104_PURCHASE_NOT_IN_REFUNDABLE_STATE',
+        'C105_PURCHASE_REFUND_AMOUNT_OVER_LIMIT',
+        'C106_TRANSACTION_NOT_VOIDABLE', 'C108_ORDER_ID_ALREADY_EXIST',
+        'C109_INVALID_TOTAL_NUMBER_INSTALLMENTS',
+        'C111_TRANSACTION_DOES_NOT_EXIST',
+        'C112_PERIODIC_PURCHASE_COMPLETE_OR_CANCELLED'),
+    # the card or the cardholder's details; another card may do
+    'card': ('C005_DECLINED', 'C200_INVALID_CREDIT_CARD_NUMBER',
+        'C201_INVALID_CREDIT_CARD_EXPIRY_DATE',
+        'C202_INVALID_CREDIT_CARD_CVV2_FORMAT', 'C203_INVALID_ZIP_FORMAT',
+        'C204_INVALID_STREET_FORMAT', 'C220_CVV2_VERIFICATION_FAILED',
+        'C221_CVV2_VERIFICATION_NOT_SUPPORTED', 'C222_AVS_FAILED',
+        'C223_AVS_NOT_SUPPORTED', 'C224_CREDIT_CARD_EXPIRED',
+        'C225_CARD_NOT_SUPPORTED', 'C226_CARD_LIMIT_EXCEEDED',
+        'C227_CARD_LOST_OR_STOLEN'),
+    'storage': ('C300_STORAGE_TOKEN_ID_ALREADY_IN_USE',
+        'C301_STORAGE_RECORD_DOES_NOT_EXIST',
+        'C302_NO_CREDIT_CARD_IN_STORAGE_RECORD'),
+    'fraud': ('C400_DECLINED_FROM_FRAUD_PROVIDER',
+        'C401_APPROVED_FROM_FRAUD_PROVIDER',
+        'C402_REVIEW_FROM_FRAUD_PROVIDER'),
+}
 
-    if credit_card_number and expiry_date and storage_token_id:
-        raise Error('Only provide CC and Exp OR StorageID not both')
+# errors after which the same request may well succeed later; purchases
+# and refunds still need checking before a resend, see RetryPolicy
+RETRYABLE_ERRORS = frozenset([
+    'C001_TIMED_OUT',
+    'C002_SYSTEM_ERROR',
+    'C003_NETWORK_ERROR',
+    'C107_REQUEST_DENIED',
+])
+
+class ErrorKind(object):
+    """ What an error is about, see classify() """
+
+    __slots__ = ('code', 'category', 'retryable', 'fraud', 'card',
+        'merchant_config')
+
+    def __init__(self, code, category, retryable=False):
+        self.code = code
+        self.category = category
+        self.retryable = retryable
+        self.fraud = category == 'fraud'
+        self.card = category == 'card'
+        self.merchant_config = category == 'merchant_config'
 
-    if not storage_token_id and not credit_card_number and not expiry_date:
-        raise Error('Need to provide a CC and Exp or StorageID')
+    def __repr__(self):
+        return '<ErrorKind %s %s%s>' % (self.code, self.category,
+            ' retryable' if self.retryable else '')
+
+ERROR_KINDS = {}
+for _category, _codes in ERROR_CATEGORIES.items():
+    for _code in _codes:
+        ERROR_KINDS[_code] = ErrorKind(_code, _category,
+            _code in RETRYABLE_ERRORS)
+
+def _set_kind(cls, kind):
+    cls.kind = kind
+    cls.retryable = kind.retryable
+    cls.fraud = kind.fraud
+    cls.card = kind.card
+    cls.merchant_config = kind.merchant_config
+
+# raised on our side: bad arguments and the like, or an unknown reply
+_set_kind(Error, ErrorKind(None, 'client'))
+for _code, _cls in ERROR_MAP.items():
+    _set_kind(_cls, ERROR_KINDS[_code])
+# shed before reaching the gateway, so fine to try again later
+_set_kind(CircuitOpen, ErrorKind(None, 'client', retryable=True))
+_set_kind(Overloaded, ErrorKind(None, 'client', retryable=True))
+del _category, _codes, _code, _cls
+
+def classify(error):
+    """ ErrorKind of an exception, exception class or ERROR_MAP code.
+    Anything unknown, including exceptions that aren't ours, is classed as
+    'client'.
+    """
+
+    if error.__class__ is str:
+        return ERROR_KINDS.get(error, Error.kind)
+    if not isinstance(error, type):
+        error = error.__class__
+    return getattr(error, 'kind', Error.kind)
+
+# request params that must never reach a log line, with how to mask them
+def _mask_all(value):
+    return '***'
+
+def _mask_pan(value):
+    value = str(value)
+    return '*' * max(len(value) - 4, 0) + value[-4:]
+
+SENSITIVE_PARAMS = {
+    'apiToken': _mask_all,
+    'creditCardNumber': _mask_pan,
+    'cvv': _mask_all,
+    'cvv2': _mask_all,
+}
+
+# the same fields as they may appear in a key=value body, in either naming
+_SENSITIVE_LINE = re.compile(
+    r'(?im)^(apiToken|cvv2?|credit_?card_?number)=([^\r\n]*)')
+
+def _mask_line(match):
+    name, value = match.groups()
+    if name.lower().startswith('credit'):
+        return '%s=%s' % (name, _mask_pan(value))
+    return '%s=***' % name
+
+def redact_params(params):
+    """ Copy of request params with card data and credentials masked """
+
+    redacted = dict(params)
+    for name, mask in SENSITIVE_PARAMS.items():
+        if redacted.get(name) is not None:
+            redacted[name] = mask(redacted[name])
+    return redacted
+
+def redact_text(text):
+    """ Mask card data and credentials in a key=value gateway body """
+
+    if text.__class__ is not str:
+        text = text.decode(RESPONSE_ENCODING)
+    return _SENSITIVE_LINE.sub(_mask_line, text)
+
+class Redacted(object):
+    """ Log argument that redacts params or a body only when formatted, so
+    nothing is copied or masked for records that are never emitted
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        if isinstance(self.value, dict):
+            return str(redact_params(self.value))
+        return redact_text(self.value)
+
+    __repr__ = __str__
+
+# ERROR_MAP code for each exception class, for reporting errors raised on
+# our side (a client timeout is still a TimedOut) under the gateway's codes
+ERROR_CODES = dict((cls, code) for code, cls in ERROR_MAP.items())
+
+def _error_code(error):
+    code = ERROR_CODES.get(error.__class__)
+    if code is None:
+        code = error.args[0] if error.args and error.args[0] in ERROR_MAP \
+            else error.__class__.__name__
+    return code
+
+class CallInfo(object):
+    """ What instrumentation hooks get to see about one gateway request.
+
+    Request params are deliberately left out, they hold card data. Fields not
+    known yet when a hook runs are None.
+    """
+
+    __slots__ = ('request_code', 'operation_code', 'start', 'elapsed',
+        'status_code', 'bytes_sent', 'bytes_received', 'connection_reused',
+        'receipt', 'error')
+
+    def __init__(self, params):
+        self.request_code = params.get('requestCode')
+        self.operation_code = params.get('operationCode')
+        self.start = time.time()
+        self.elapsed = None
+        self.status_code = None
+        self.bytes_sent = None
+        self.bytes_received = None
+        self.connection_reused = None
+        self.receipt = None
+        self.error = None
+
+    @property
+    def error_code(self):
+        """ ERROR_MAP code of the error, or its class name if unmapped """
+
+        if self.error is None:
+            return None
+        return _error_code(self.error)
+
+class Instrument(object):
+    """ Base class for instrumentation hooks passed as Salt(instruments=[]).
+
+    Hooks run synchronously on the calling thread for every HTTP request,
+    retries included, so keep them cheap. An exception in a hook is logged
+    and otherwise ignored.
+    """
+
+    def before_request(self, info):
+        """ Called before the request is sent """
+
+    def after_response(self, info):
+        """ Called once a response was received, whatever it says """
+
+    def on_error(self, info):
+        """ Called when the call raises, ``info.error`` holds the exception """
+
+# the gateway replies with plain ASCII text/plain; latin-1 is what requests
+# assumed for it and decodes any byte without failing
+RESPONSE_ENCODING = 'iso-8859-1'
+
+
+# Receipt fields holding numbers. Parsed values are left as the strings the
+# gateway sent and only converted when read through ResponseBody.typed
+NUMERIC_FIELDS = {
+    'TRANSACTION_ID': int,
+    'AMOUNT': int,
+    'APPROVED_AMOUNT': int,
+    'RESPONSE_CODE': int,
+    'REFERENCE_NUMBER': int,
+    'BATCH_ID': int,
+    'PERIODIC_PURCHASE_STATE_CODE': int,
+    'PERIODIC_PURCHASE_INSTALLMENT_COUNT': int,
+    'FRAUD_SESSION_ID': int,
+}
+
+class ResponseBody(dict):
+    """ The key=value pairs of a gateway reply, with 'true'/'false' already
+    turned into booleans. Use typed() to read NUMERIC_FIELDS as numbers.
+    """
+
+    __slots__ = ()
+
+    def typed(self, key, default=None):
+        """ Return the field converted by its NUMERIC_FIELDS type, or as-is
+        for unknown fields and values that don't convert.
+        """
+
+        value = self.get(key)
+        if value is None:
+            return default
+
+        convert = NUMERIC_FIELDS.get(key)
+        if convert is None or value.__class__ is bool:
+            return value
+        try:
+            return convert(value)
+        except ValueError:
+            return value
+
+def parse_response(raw):
+    """ Parse a gateway reply of newline separated key=value pairs into a
+    ResponseBody.
+
+    ``raw`` may be the body bytes or already decoded text. Only the first '='
+    on a line separates key and value, a final line without a newline is kept
+    and blank lines and '\\r' line endings are tolerated.
+    """
+
+    if raw.__class__ is not str:
+        raw = raw.decode(RESPONSE_ENCODING)
+
+    if '\r' in raw:
+        raw = raw.replace('\r', '')
+
+    # split/partition run in C and measure faster than scanning indexes in
+    # Python; the ResponseBody is filled directly rather than copied from a
+    # plain dict. See bench.py parse
+    body = ResponseBody()
+    for line in raw.split('\n'):
+        key, sep, value = line.partition('=')
+        if not sep:
+            continue
+        if value == 'true':
+            value = True
+        elif value == 'false':
+            value = False
+        body[key] = value
+    return body
+
+class Receipt(collections.abc.Mapping):
+    """ A gateway reply, kept as the raw body bytes and parsed on first use.
+
+    Behaves as a read-only mapping of the reply's fields, as returned by
+    parse_response, so ``receipt['ERROR_MESSAGE']`` works as it did when
+    calls returned dicts. error_message is read straight from the bytes,
+    which lets Salt.call check for success without parsing anything else.
+    """
+
+    __slots__ = ('raw', '_fields')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._fields = None
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = parse_response(self.raw)
+        return self._fields
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def typed(self, key, default=None):
+        return self.fields.typed(key, default)
+
+    @property
+    def error_message(self):
+        if self._fields is not None:
+            return self._fields.get('ERROR_MESSAGE')
+
+        raw = self.raw
+        start = raw.find(b'ERROR_MESSAGE=')
+        while start > 0 and raw[start - 1:start] != b'\n':
+            start = raw.find(b'ERROR_MESSAGE=', start + 1)
+        if start < 0:
+            return None
+
+        start += len(b'ERROR_MESSAGE=')
+        end = raw.find(b'\n', start)
+        if end < 0:
+            end = len(raw)
+        return raw[start:end].rstrip(b'\r').decode(RESPONSE_ENCODING)
+
+    @property
+    def success(self):
+        return self.error_message == 'SUCCESS'
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.error_message)
+
+class PurchaseReceipt(Receipt):
+    """ Reply to purchases, voids, refunds, verifications and fraud
+    updates
+    """
+
+    __slots__ = ()
+
+    @property
+    def approved(self):
+        return self.fields.get('APPROVED') is True
+
+    @property
+    def transaction_id(self):
+        return self.typed('TRANSACTION_ID')
+
+    @property
+    def order_id(self):
+        return self.fields.get('ORDER_ID')
+
+    @property
+    def amount(self):
+        return self.typed('APPROVED_AMOUNT', self.typed('AMOUNT'))
+
+    @property
+    def approval_code(self):
+        return self.fields.get('APPROVAL_CODE')
+
+    @property
+    def avs_response_code(self):
+        return self.fields.get('AVS_RESPONSE_CODE')
 
+    @property
+    def cvv2_response_code(self):
+        return self.fields.get('CVV2_RESPONSE_CODE')
+
+class StorageReceipt(Receipt):
+    """ Reply to SecureStorage operations """
+
+    __slots__ = ()
+
+    @property
+    def storage_token_id(self):
+        return self.fields.get('STORAGE_TOKEN_ID')
+
+    @property
+    def credit_card_number(self):
+        """ the card number as masked by the gateway """
+        return self.fields.get('CREDIT_CARD_NUMBER')
+
+    @property
+    def expiry_date(self):
+        return self.fields.get('EXPIRY_DATE')
+
+class RecurringReceipt(PurchaseReceipt):
+    """ Reply to RecurringPurchase operations """
+
+    __slots__ = ()
+
+    @property
+    def periodic_purchase_state_code(self):
+        return self.typed('PERIODIC_PURCHASE_STATE_CODE')
+
+    @property
+    def next_payment_date(self):
+        return self.fields.get('NEXT_PAYMENT_DATE')
+
+# receipt class for each requestCode, anything else is a PurchaseReceipt
+RECEIPT_TYPES = {
+    'secureStorage': StorageReceipt,
+    'recurringPurchase': RecurringReceipt,
+    'batch': Receipt,
+}
+
+class BatchResult(object):
+    """ Outcome of one operation submitted through Salt.submit_many
+
+    Exactly one of ``receipt`` and ``error`` is set; ``error`` holds the
+    exception the call raised, normally one of the ERROR_MAP classes.
+    """
+
+    __slots__ = ('index', 'operation', 'receipt', 'error')
+
+    def __init__(self, index, operation, receipt=None, error=None):
+        self.index = index
+        self.operation = operation
+        self.receipt = receipt
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '<BatchResult #%s %s %s>' % (self.index,
+            getattr(self.operation, '__name__', self.operation),
+            'ok' if self.ok else repr(self.error))
+
+# requests that are safe to send again as they are after a timeout
+RETRYABLE_REQUESTS = frozenset([
+    'verifyTransaction',
+    'verifyCreditCard',
+])
+
+# requests that move money: before sending them again we look the order up
+# with a verifyTransaction and only resend if the gateway never recorded it
+RECONCILED_REQUESTS = frozenset([
+    'singlePurchase',
+    'refund',
+])
+
+class RetryPolicy(object):
+    """ Retry gateway calls that failed without a definite answer.
+
+    Calls failing with one of ``retry_on`` (TimedOut and NetworkError by
+    default) are attempted again after an exponential backoff with full
+    jitter, until ``attempts`` tries or ``deadline`` seconds have been spent.
+
+    Only requests in RETRYABLE_REQUESTS are blindly resent. Purchases and
+    refunds (RECONCILED_REQUESTS) are first verified by their order ID: if the
+    gateway has the transaction its verification receipt is returned instead
+    of charging twice, and only a TransactionDoesNotExist answer lets the
+    request go out again. Anything else is raised on the first failure.
+    """
+
+    def __init__(self, attempts=3, backoff=0.5, max_backoff=10.0,
+        deadline=30.0, retry_on=(TimedOut, NetworkError)):
+        """
+        Optional Args:
+            attempts (int): tries in total, including the first and the
+                verifications before resending a purchase or refund,
+                defaults to 3
+            backoff (float): seconds to wait before the first retry, doubled
+                on each retry, defaults to 0.5
+            max_backoff (float): cap on a single wait, defaults to 10
+            deadline (float): seconds one operation may take in total,
+                including waits, defaults to 30
+            retry_on (tuple): exception classes worth retrying
+        """
+
+        if attempts < 1: raise Error('attempts must be at least 1')
+
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.retry_on = retry_on
+        self.sleep = time.sleep
+
+    def delay(self, retry):
+        """ Seconds to wait before the given retry, counting from 1 """
+        return random.uniform(0,
+            min(self.max_backoff, self.backoff * 2 ** (retry - 1)))
+
+    def run(self, client, params):
+        """ Send ``params`` through ``client``, retrying per this policy """
+
+        if params is None: params = {}
+
+        request_code = params.get('requestCode')
+        reconcile = request_code in RECONCILED_REQUESTS and \
+            params.get('orderId')
+        if not reconcile and request_code not in RETRYABLE_REQUESTS:
+            return client._send(params)
+
+        give_up = time.time() + self.deadline
+        attempt = 1
+        verify = False
+        while True:
+            remaining = give_up - time.time()
+            if attempt > 1 and remaining <= 0:
+                raise error
+            timeout = remaining if client.timeout is None else \
+                min(client.timeout, remaining)
+            try:
+                if not verify:
+                    return client._send(params, timeout)
+
+                # a verification that finds the order settles the matter
+                try:
+                    return client._send(VERIFY_TRANSACTION.build({
+                        'transaction_order_id': params['orderId'],
+                        'market_segment_code':
+                            params.get('marketSegmentCode', 'I'),
+                    }), timeout)
+                except TransactionDoesNotExist:
+                    # the resend is an attempt of its own
+                    if attempt >= self.attempts:
+                        raise error
+                    attempt += 1
+                    verify = False
+                    continue
+                except self.retry_on:
+                    raise
+                except Error:
+                    # the gateway can't say either way, so resending could
+                    # charge twice; give up with the original error
+                    raise error
+            except self.retry_on as e:
+                error = e
+
+            if attempt >= self.attempts:
+                raise error
+
+            wait = self.delay(attempt)
+            if time.time() + wait >= give_up:
+                raise error
+
+            attempt += 1
+            verify = bool(reconcile)
+            client.log('Retrying %s in %.2fs after %r', request_code, wait,
+                error)
+            self.sleep(wait)
+
+# errors that say the gateway itself is struggling, as opposed to a verdict
+# on the request; these feed the circuit breaker and concurrency limiter
+GATEWAY_FAILURES = (SaltSystemError, TimedOut, NetworkError)
+
+class CircuitBreaker(object):
+    """ Stop calling the gateway while it is failing.
+
+    The outcome of the last ``window`` calls is tracked; once at least
+    ``min_calls`` are known and the share of GATEWAY_FAILURES (and calls
+    slower than ``slow_call``, if set) reaches ``failure_ratio`` the breaker
+    opens. While open every call raises CircuitOpen without touching the
+    network. After ``reset_timeout`` seconds a single probe call is let
+    through: success closes the breaker, failure opens it again. Calls
+    still in flight from before the breaker opened don't count as the probe.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_ratio=0.5, window=20, min_calls=10,
+        reset_timeout=30.0, slow_call=None):
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.slow_call = slow_call
+        self.state = self.CLOSED
+        self.times_opened = 0
+        self.rejected = 0
+        self._outcomes = collections.deque(maxlen=window)
+        self._opened_at = 0
+        self._probe_at = None
+        self._probe = 0
+        self._lock = threading.Lock()
+
+    def before(self):
+        """ Raise CircuitOpen unless a call may go out now. Returns the token
+        to pass record() or release(): a number for the probe call, None for
+        any other
+        """
+
+        with self._lock:
+            if self.state == self.CLOSED:
+                return None
+
+            now = time.time()
+            if self.state == self.OPEN and \
+                now - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probe_at = None
+
+            # one probe at a time; a probe that never reported back (its
+            # thread died, say) is replaced after another reset_timeout
+            if self.state == self.HALF_OPEN and (self._probe_at is None or
+                now - self._probe_at >= self.reset_timeout):
+                self._probe_at = now
+                self._probe += 1
+                return self._probe
+
+            self.rejected += 1
+            raise CircuitOpen('Circuit open after %d failures in %d calls' % (
+                sum(self._outcomes), len(self._outcomes)))
+
+    def record(self, failed, elapsed, token=None):
+        """ Report how a call admitted by before() went """
+
+        if self.slow_call is not None and elapsed > self.slow_call:
+            failed = True
+
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                # only the current probe decides; calls let through before
+                # the breaker opened are still coming back
+                if token is None or token != self._probe:
+                    return
+                if failed:
+                    self._open()
+                else:
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+                return
+
+            self._outcomes.append(failed)
+            if self.state == self.CLOSED and \
+                len(self._outcomes) >= self.min_calls and \
+                sum(self._outcomes) >= self.failure_ratio * len(self._outcomes):
+                self._open()
+
+    def release(self, token):
+        """ Give back the probe slot of a call admitted by before() that
+        never went out
+        """
+
+        with self._lock:
+            if token is not None and token == self._probe and \
+                self.state == self.HALF_OPEN:
+                self._probe_at = None
+
+    def _open(self):
+        self.state = self.OPEN
+        self.times_opened += 1
+        self._opened_at = time.time()
+        self._probe_at = None
+
+class ConcurrencyLimiter(object):
+    """ Cap concurrent gateway calls with an AIMD adaptive limit.
+
+    Each call that comes back healthy raises the limit by 1/limit (about +1
+    per limit's worth of calls); a call that fails with GATEWAY_FAILURES or
+    takes longer than ``latency_target`` multiplies it by ``backoff``. Callers
+    over the limit wait their turn, or get Overloaded after ``max_wait``
+    seconds when that is set.
+    """
+
+    def __init__(self, initial=10, minimum=1, maximum=200, backoff=0.7,
+        latency_target=None, max_wait=None):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.latency_target = latency_target
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            if self.max_wait is None:
+                while self.in_flight >= int(self.limit):
+                    self._cond.wait()
+            else:
+                give_up = time.time() + self.max_wait
+                while self.in_flight >= int(self.limit):
+                    remaining = give_up - time.time()
+                    if remaining <= 0:
+                        raise Overloaded('%d calls in flight, limit %d' % (
+                            self.in_flight, int(self.limit)))
+                    self._cond.wait(remaining)
+            self.in_flight += 1
+
+    def release(self, failed, elapsed):
+        with self._cond:
+            self.in_flight -= 1
+            if failed or (self.latency_target is not None and
+                elapsed > self.latency_target):
+                self.limit = max(self.minimum, self.limit * self.backoff)
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+def _reserve(state, now, rate, burst):
+    # virtual scheduling (GCRA): ``state`` is the time the bucket will next
+    # be empty. A caller takes the slot at that time, less the burst
+    # allowance, and callers are served strictly in the order they reserve.
+    interval = 1.0 / rate
+    due = max(state or now, now)
+    return due + interval, max(0.0, due - (burst - 1) * interval - now)
+
+class TokenBucket(object):
+    """ Pace calls to ``rate`` per second, allowing bursts of up to ``burst``
+    calls after a quiet spell. Callers wait in the order they arrive: each
+    reserves the next free slot, then sleeps until it comes round.
+    """
+
+    def __init__(self, rate, burst=1):
+        if rate <= 0: raise Error('rate must be positive')
+
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self._due = None
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """ Take the next slot, returning the seconds to wait for it """
+
+        with self._lock:
+            self._due, delay = _reserve(self._due, time.monotonic(),
+                self.rate, self.burst)
+        return delay
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+# answers meaning the merchant is sending faster than the gateway allows
+RATE_DENIALS = (RequestDenied, TransactionExceedsAccountLimits)
+
+class RateLimitBackend(object):
+    """ Where a RateLimiter keeps its buckets.
+
+    Each bucket's state is a [due, rate] list, or None before first use.
+    update() must apply ``func`` to a bucket's state atomically, store the
+    new state it returns and hand back its result.
+    """
+
+    def update(self, key, func):
+        raise NotImplementedError
+
+class LocalRateLimitBackend(RateLimitBackend):
+    """ Buckets in memory, shared by the threads of this process """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def update(self, key, func):
+        with self._lock:
+            state, result = func(self._buckets.get(key))
+            self._buckets[key] = state
+            return result
+
+class FileRateLimitBackend(RateLimitBackend):
+    """ Buckets in a small JSON file, locked with flock around each update,
+    so every process on the host using the same path shares them. POSIX
+    only.
+    """
+
+    def __init__(self, path):
+        import fcntl
+
+        self.path = path
+        self._fcntl = fcntl
+
+    def update(self, key, func):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        with os.fdopen(fd, 'r+') as f:
+            self._fcntl.flock(f, self._fcntl.LOCK_EX)
+            try:
+                buckets = json.loads(f.read() or '{}')
+            except ValueError:
+                # torn by a crash mid-write; start the buckets afresh
+                buckets = {}
+            state, result = func(buckets.get(key))
+            buckets[key] = state
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(buckets))
+            f.flush()
+            # closing the file releases the lock
+        return result
+
+class RateLimiter(object):
+    """ Token-bucket limits on call rate, per merchant and per requestCode.
+
+    Every merchant gets a bucket of ``rate`` calls per second; request codes
+    listed in ``rates`` also get a bucket of their own, per merchant, and a
+    call waits for both. Callers queue in arrival order rather than being
+    refused, unless ``max_wait`` is set and their turn is further off, in
+    which case they get Overloaded.
+
+    A RATE_DENIALS answer means the gateway wants fewer calls: the buckets
+    behind it have their rate multiplied by ``backoff``, down to ``minimum``
+    times the configured rate. Each call let through after that wins back
+    ``recovery`` times the configured rate, up to the configured rate.
+
+    Optional Args:
+        rate (float): calls per second per merchant, defaults to 10
+        rates (dict): requestCode to calls per second per merchant
+        burst (int): calls allowed at once after a quiet spell, defaults
+            to 1
+        backoff (float): defaults to 0.5
+        minimum (float): defaults to 0.1
+        recovery (float): defaults to 0.02
+        max_wait (float): longest wait in seconds, unlimited by default
+        backend (RateLimitBackend): defaults to this process only, pass a
+            FileRateLimitBackend to share the limits between processes
+    """
+
+    def __init__(self, rate=10.0, rates=None, burst=1, backoff=0.5,
+        minimum=0.1, recovery=0.02, max_wait=None, backend=None):
+        if rate <= 0 or any(r <= 0 for r in (rates or {}).values()):
+            raise Error('rates must be positive')
+
+        self.rate = float(rate)
+        self.rates = dict(rates or {})
+        self.burst = max(1, burst)
+        self.backoff = backoff
+        self.minimum = minimum
+        self.recovery = recovery
+        self.max_wait = max_wait
+        self.backend = backend if backend is not None else \
+            LocalRateLimitBackend()
+        self._lock = threading.Lock()
+        self.waited = 0.0
+        self.denied = 0
+
+    def _buckets(self, merchant_id, request_code):
+        merchant_id = str(merchant_id)
+        yield merchant_id, self.rate
+        if request_code in self.rates:
+            yield '%s/%s' % (merchant_id, request_code), \
+                self.rates[request_code]
+
+    def acquire(self, merchant_id, request_code=None):
+        """ Wait for this merchant's turn to send a ``request_code`` call """
+
+        delay = 0.0
+        for key, configured in self._buckets(merchant_id, request_code):
+            delay = max(delay, self.backend.update(key,
+                lambda state: self._take(state, configured)))
+        if delay:
+            with self._lock:
+                self.waited += delay
+            time.sleep(delay)
+
+    def _take(self, state, configured):
+        due, rate = state or (None, configured)
+        rate = min(configured, rate + configured * self.recovery)
+        new_due, delay = _reserve(due, time.time(), rate, self.burst)
+        if self.max_wait is not None and delay > self.max_wait:
+            raise Overloaded('Rate limited for another %.3fs' % delay)
+        return [new_due, rate], delay
+
+    def denied_call(self, merchant_id, request_code=None):
+        """ Slow down after the gateway denied a call as over its limits """
+
+        with self._lock:
+            self.denied += 1
+        for key, configured in self._buckets(merchant_id, request_code):
+            self.backend.update(key,
+                lambda state: (self._back_off(state, configured), None))
+
+    def _back_off(self, state, configured):
+        due, rate = state or (None, configured)
+        return [due, max(configured * self.minimum, rate * self.backoff)]
+
+    def current_rate(self, merchant_id, request_code=None):
+        """ The calls per second allowed right now, after adapting """
+
+        rates = []
+        for key, configured in self._buckets(merchant_id, request_code):
+            state = self.backend.update(key, lambda state: (state, state))
+            rates.append(state[1] if state else configured)
+        return min(rates)
+
+# read-only (requestCode, operationCode) pairs: identical calls in flight at
+# the same moment can all be given the reply to one of them
+COALESCED_REQUESTS = frozenset([
+    ('verifyTransaction', None),
+    ('secureStorage', 'query'),
+])
+
+class _Flight(object):
+    __slots__ = ('done', 'receipt', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.receipt = None
+        self.error = None
+
+class SingleFlight(object):
+    """ Let concurrent identical read-only calls share one gateway request.
+
+    The first caller makes the request; anyone asking the same thing of the
+    same merchant before it returns waits for it and gets the same receipt,
+    or the same exception. ``calls`` counts the gateway requests made and
+    ``deduplicated`` the callers who were spared one. May be shared between
+    clients.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.calls = 0
+        self.deduplicated = 0
+
+    def do(self, key, func):
+        """ Return func(), or the outcome of the call already running for
+        ``key``
+        """
+
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+                leader = True
+            else:
+                self.deduplicated += 1
+                leader = False
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.receipt
+
+        try:
+            flight.receipt = func()
+            return flight.receipt
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    @property
+    def in_flight(self):
+        return len(self._flights)
+
+class TransportResponse(object):
+    """ What a transport hands back for one POST.
+
+    ``remote_addr`` is the (host, port) the request went to, ``bytes_sent``
+    the size of the request body and ``reused`` whether a connection left
+    open by an earlier request carried it; each is None when the transport
+    can't tell.
+    """
+
+    __slots__ = ('status_code', 'content', 'remote_addr', 'bytes_sent',
+        'reused')
+
+    def __init__(self, status_code, content, remote_addr=(None, None),
+        bytes_sent=None, reused=None):
+        self.status_code = status_code
+        self.content = content
+        self.remote_addr = remote_addr
+        self.bytes_sent = bytes_sent
+        self.reused = reused
+
+class Transport(object):
+    """ How Salt gets a request to the gateway and its reply back.
+
+    post() must raise TimedOut when ``timeout`` seconds pass without a reply
+    and NetworkError when the gateway can't be reached; every other outcome,
+    gateway errors included, is a TransportResponse.
+    """
+
+    def post(self, url, body, headers, timeout=None):
+        """ POST the form-encoded ``body`` bytes, returning a
+        TransportResponse
+        """
+        raise NotImplementedError
+
+    def ensure_pool_size(self, url, size):
+        """ Keep at least ``size`` connections to ``url`` open at once """
+
+    def warm(self, url, connections=1):
+        """ Open ``connections`` connections to ``url`` ahead of the first
+        calls, so they don't pay for the TCP and TLS handshakes
+        """
+
+    def close(self):
+        pass
+
+def _keepalive_options(idle, interval, count):
+    import socket
+
+    options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    # the per-socket tuning is not available everywhere (macOS lacks
+    # TCP_KEEPIDLE, Windows all three)
+    for name, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval),
+        ('TCP_KEEPCNT', count)):
+        if hasattr(socket, name):
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    return options
+
+def _connection_classes():
+    # urllib3 connection and pool classes that remember the peer address
+    # and whether the connection was open before the request, so neither
+    # has to be dug out of the response's private fields
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, \
+        HTTPSConnectionPool
+
+    class _Tracked(object):
+        peer = (None, None)
+        reused = None
+
+        def connect(self):
+            super(_Tracked, self).connect()
+            try:
+                self.peer = self.sock.getpeername()[:2]
+            except (OSError, AttributeError):
+                self.peer = (None, None)
+
+        def request(self, *args, **kwargs):
+            # already connected, by an earlier request or by warm()
+            self.reused = self.sock is not None
+            return super(_Tracked, self).request(*args, **kwargs)
+
+    class _HTTPConnection(_Tracked, HTTPConnection): pass
+    class _HTTPSConnection(_Tracked, HTTPSConnection): pass
+
+    class _HTTPPool(HTTPConnectionPool):
+        ConnectionCls = _HTTPConnection
+
+    class _HTTPSPool(HTTPSConnectionPool):
+        ConnectionCls = _HTTPSConnection
+
+    return {'http': _HTTPPool, 'https': _HTTPSPool}
+
+class RequestsTransport(Transport):
+    """ The default transport: a requests session over keep-alive HTTP/1.1
+    connections.
+
+    Optional Args:
+        pool_size (int): connections kept open per gateway host, defaults
+            to 10
+        connect_timeout (float): seconds to wait for a connection, defaults
+            to the call's timeout
+        read_timeout (float): seconds to wait for a reply when the call sets
+            no timeout of its own, unlimited by default
+        keepalive (float): seconds a connection may sit idle before TCP
+            keep-alive probes start, so dead connections are found before a
+            charge is sent down them, defaults to 30; None turns probes off
+        session (requests.Session): share connections with other clients,
+            this transport takes its pool settings over
+    """
+
+    def __init__(self, pool_size=10, connect_timeout=None, read_timeout=None,
+        keepalive=30, session=None):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keepalive = keepalive
+        self._session = session
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        # created on first use; AsyncSalt and in-memory clients never need it
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+
+                    session = requests.session()
+                    self._mount(session, self.pool_size)
+                    self._session = session
+        return self._session
+
+    def _mount(self, session, size):
+        options = None
+        if self.keepalive is not None:
+            from urllib3.connection import HTTPConnection
+
+            options = HTTPConnection.default_socket_options + \
+                _keepalive_options(int(self.keepalive),
+                    max(1, int(self.keepalive) // 3), 3)
+        adapter = _adapter_class()(pool_connections=4, pool_maxsize=size,
+            socket_options=options)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+    def ensure_pool_size(self, url, size):
+        # requests keeps only 10 connections per host by default; any extra
+        # workers would open and drop a fresh connection on every call
+        adapter = self.session.get_adapter(url)
+        if getattr(adapter, '_pool_maxsize', size) < size:
+            with self._lock:
+                self.pool_size = max(self.pool_size, size)
+                self._mount(self.session, self.pool_size)
+
+    def warm(self, url, connections=1):
+        import concurrent.futures
+        import requests
+
+        session = self.session
+        adapter = session.get_adapter(url)
+        try:
+            # the same pool post() will pick, CA bundle and proxies included
+            settings = session.merge_environment_settings(url, {}, None,
+                None, None)
+            if hasattr(adapter, 'get_connection_with_tls_context'):
+                pool = adapter.get_connection_with_tls_context(
+                    requests.Request('POST', url).prepare(),
+                    settings['verify'], settings['proxies'], settings['cert'])
+            else:
+                # requests before 2.32.2
+                pool = adapter.get_connection(url, settings['proxies'])
+            conns = [pool._get_conn() for _ in range(connections)]
+        except Exception as e:
+            # urllib3 keeps no public way of opening pooled connections;
+            # warming is only ever an optimisation, but say it didn't happen
+            logger.warning('Unable to warm connections to %s with requests '
+                '%s: %r', url, requests.__version__, e)
+            return 0
+
+        def connect(conn):
+            try:
+                conn.connect()
+                return True
+            except OSError:
+                return False
+
+        with concurrent.futures.ThreadPoolExecutor(connections) as executor:
+            opened = sum(executor.map(connect, conns))
+        for conn in conns:
+            pool._put_conn(conn)
+        return opened
+
+    def post(self, url, body, headers, timeout=None):
+        import requests
+
+        read = timeout if timeout is not None else self.read_timeout
+        connect = self.connect_timeout if self.connect_timeout is not None \
+            else read
+        try:
+            response = self.session.post(url, data=body, headers=headers,
+                timeout=(connect, read), stream=True)
+            # the connection is only released to the pool once the body is
+            # read, look at it first
+            connection = getattr(response.raw, 'connection', None)
+            remote_addr = getattr(connection, 'peer', (None, None))
+            reused = getattr(connection, 'reused', None)
+            content = response.content
+        except requests.exceptions.Timeout as e:
+            raise TimedOut('No response from %s: %s' % (url, e))
+        except requests.exceptions.ConnectionError as e:
+            raise NetworkError('Unable to reach %s: %s' % (url, e))
+
+        return TransportResponse(response.status_code, content, remote_addr,
+            len(body), reused)
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+_TrackedAdapter = None
+
+def _adapter_class():
+    # defined on first use so importing this module doesn't import requests;
+    # kept as the module's _TrackedAdapter so adapters still pickle
+    global _TrackedAdapter
+    if _TrackedAdapter is not None:
+        return _TrackedAdapter
+
+    from requests.adapters import HTTPAdapter
+
+    class _TrackedAdapter(HTTPAdapter):
+        def __init__(self, socket_options=None, **kwargs):
+            self.socket_options = socket_options
+            HTTPAdapter.__init__(self, **kwargs)
+
+        def init_poolmanager(self, *args, **kwargs):
+            if self.socket_options is not None:
+                kwargs['socket_options'] = self.socket_options
+            HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = _connection_classes()
+
+        def __getstate__(self):
+            state = HTTPAdapter.__getstate__(self)
+            state['socket_options'] = self.socket_options
+            return state
+
+    _TrackedAdapter.__qualname__ = '_TrackedAdapter'
+    return _TrackedAdapter
+
+class InMemoryTransport(Transport):
+    """ Answers calls in-process, for tests and benchmarks.
+
+    Args:
+        responder (bytes or callable): the reply body to every request, or a
+            function of the request params dict returning the reply body, or
+            a (status_code, body) tuple; StubGateway.respond is one
+
+    The params of the latest ``history`` requests are kept in ``requests``.
+    """
+
+    def __init__(self, responder, history=100):
+        self.responder = responder
+        self.requests = collections.deque(maxlen=history)
+        self.calls = 0
+
+    def post(self, url, body, headers, timeout=None):
+        params = dict(parse_qsl(body.decode('ascii'), keep_blank_values=True))
+        self.requests.append(params)
+        self.calls += 1
+
+        responder = self.responder
+        reply = responder(params) if callable(responder) else responder
+        status_code = 200
+        if isinstance(reply, tuple):
+            status_code, reply = reply
+        if isinstance(reply, str):
+            reply = reply.encode(RESPONSE_ENCODING)
+        return TransportResponse(status_code, reply, ('127.0.0.1', 0),
+            len(body), self.calls > 1)
+
+# Local validation, raising the same exceptions the gateway would answer with
+# each digit to the digit sum of its double, for the Luhn check
+_LUHN_DOUBLED = str.maketrans('0123456789', '0246813579')
+_EXPIRY_DATE = re.compile(r'^\d\d(0[1-9]|1[0-2])$')
+_CVV = re.compile(r'^\d{3,4}$')
+_ZIP = re.compile(r'^(\d{5}(-?\d{4})?|[A-Za-z]\d[A-Za-z] ?\d[A-Za-z]\d)$')
+
+def _check_card_number(value):
+    digits = str(value)
+    # summing the ASCII bytes and taking off ord('0') per digit is several
+    # times cheaper than int() on every character
+    if not digits.isascii() or not digits.isdigit() or \
+        not 12 <= len(digits) <= 19 or (sum((digits[-1::-2] +
+        digits[-2::-2].translate(_LUHN_DOUBLED)).encode('ascii')) -
+        48 * len(digits)) % 10:
+        raise InvalidCreditCardNumber('C200_INVALID_CREDIT_CARD_NUMBER')
+
+# ints are sent as they are, so one that needs zero padding (912, a CVV of
+# 12) would reach the gateway malformed: they must match without it
+def _check_expiry_date(value):
+    if not _EXPIRY_DATE.match(str(value)):
+        raise InvalidCreditCardExpiryDate(
+            'C201_INVALID_CREDIT_CARD_EXPIRY_DATE')
+
+def _check_cvv(value):
+    if not _CVV.match(str(value)):
+        raise InvalidCreditCardCVV2Format('C202_INVALID_CREDIT_CARD_CVV2_FORMAT')
+
+def _check_zip(value):
+    if value != '' and not _ZIP.match(str(value)):
+        raise InvalidZipFormat('C203_INVALID_ZIP_FORMAT')
+
+def _check_amount(value):
+    # amounts are sent in cents, so a positive whole number; strings, from
+    # forms or CSV files, are sent as they are and must be all digits
+    if isinstance(value, str):
+        ok = value.isascii() and value.isdigit() and int(value) > 0
+    else:
+        try:
+            ok = value.__class__ is not bool and value == int(value) and \
+                value > 0
+        except (TypeError, ValueError, OverflowError):
+            ok = False
+    if not ok:
+        raise AmountOutOfBounds('C101_AMOUNT_OUT_OF_BOUNDS')
+
+# default for optional params that are only sent when given
+_OMIT = object()
+
+class Param(object):
+    """ One request parameter: the keyword argument it is read from, the name
+    it is sent as, its default and an optional validator
+    """
+
+    __slots__ = ('arg', 'name', 'default', 'validator')
+
+    def __init__(self, arg, name, default=_OMIT, validator=None):
+        self.arg = arg
+        self.name = name
+        self.default = default
+        self.validator = validator
+
+def _add_card(params, values, validate=False):
+    """ Add the credit card or storage token in ``values`` to ``params``;
+    called by the builders of card Operations
+    """
+
+    get = values.get
+    storage_token_id = get('storage_token_id')
+    credit_card_number = get('credit_card_number')
+    expiry_date = get('expiry_date')
     if storage_token_id:
-        return { 'storageTokenId': storage_token_id }
+        if credit_card_number and expiry_date:
+            raise Error('Only provide CC and Exp OR StorageID not both')
+        params['storageTokenId'] = storage_token_id
+    elif not credit_card_number and not expiry_date:
+        raise Error('Need to provide a CC and Exp or StorageID')
     else:
-        return {
-            'creditCardNumber': credit_card_number,
-            'expiry_date': expiry_date
-        }
-    raise Error('No CC or Storage info found')
+        if validate:
+            _check_card_number(credit_card_number)
+            _check_expiry_date(expiry_date)
+        params['creditCardNumber'] = credit_card_number
+        params['expiryDate'] = expiry_date
+
+def _literal(value):
+    """ Source for ``value`` if it can be written as a constant, else None """
+
+    if value is None or value.__class__ in (str, int, bool):
+        return repr(value)
+    return None
+
+class Operation(object):
+    """ A request type, declared once as its codes and Params and compiled
+    into a builder that turns keyword arguments into request params.
+
+    ``card`` adds the credit card or storage token params, see _add_card;
+    ``constants`` are params sent as-is with every request.
+
+    The builder is generated as straight-line Python per Operation, one
+    lookup and check per Param with names and defaults inlined as
+    constants, so building costs about what a hand-written dict would
+    rather than a loop over the Params, plus one _add_card call for card
+    Operations; see bench.py build.
+    """
+
+    def __init__(self, request_code, operation_code=None, params=(),
+        card=False, constants=None):
+        fixed = {'requestCode': request_code}
+        if operation_code is not None:
+            fixed['operationCode'] = operation_code
+        fixed.update(constants or {})
+
+        self.request_code = request_code
+        self.operation_code = operation_code
+        self._fixed = fixed
+        self._params = tuple((param.arg, param.name, param.default,
+            param.validator) for param in params)
+        self._card = card
+        self.build = self._compile()
+
+    def _compile(self):
+        namespace = {'_fixed': self._fixed, '_add_card': _add_card}
+
+        items = [_literal(key) and _literal(value) and '%s: %s' % (
+            _literal(key), _literal(value))
+            for key, value in self._fixed.items()]
+        if all(items):
+            lines = ['    params = {%s}' % ', '.join(items)]
+        else:
+            lines = ['    params = _fixed.copy()']
+        lines.append('    get = values.get')
+
+        for number, (arg, name, default, validator) in \
+            enumerate(self._params):
+            if default is _OMIT:
+                lines.append('    value = get(%r)' % arg)
+            else:
+                source = _literal(default)
+                if source is None:
+                    source = '_default%d' % number
+                    namespace[source] = default
+                lines.append('    value = get(%r, %s)' % (arg, source))
+            lines.append('    if value is not None:')
+            if validator is not None:
+                namespace['_check%d' % number] = validator
+                lines.append('        if validate: _check%d(value)' % number)
+            lines.append('        params[%r] = value' % name)
+
+        if self._card:
+            lines.append('    _add_card(params, values, validate)')
+        lines.append('    return params')
+
+        source = 'def build(values, validate=True):\n' + '\n'.join(lines)
+        exec(compile(source, '<Operation %s %s>' % (self.request_code,
+            self.operation_code or ''), 'exec'), namespace)
+        build = namespace['build']
+        build.__doc__ = """ Request params from a dict of keyword arguments,
+        raising the matching ERROR_MAP exception for values the gateway would
+        refuse
+        """
+        return build
+
+_MARKET_SEGMENT = Param('market_segment_code', 'marketSegmentCode', 'I')
+_AVS_REQUEST = Param('avs_request_code', 'avsRequestCode', 0)
+_CVV2_REQUEST = Param('cvv2_request_code', 'cvv2RequestCode', 0)
+_CVV_PARAM = Param('cvv', 'cvv', validator=_check_cvv)
+
+SINGLE_PURCHASE = Operation('singlePurchase', params=(
+    Param('amount', 'amount', validator=_check_amount),
+    Param('order_id', 'orderId'),
+    Param('zip', 'zip', '', _check_zip),
+    Param('street', 'street', ''),
+    _MARKET_SEGMENT,
+    _AVS_REQUEST,
+    _CVV2_REQUEST,
+    _CVV_PARAM,
+), card=True)
+
+VOID = Operation('void', params=(
+    Param('transaction_id', 'transactionId'),
+    Param('transaction_order_id', 'transactionOrderId'),
+    _MARKET_SEGMENT,
+))
+
+REFUND = Operation('refund', params=(
+    Param('transaction_id', 'transactionId'),
+    Param('transaction_order_id', 'transactionOrderId'),
+    Param('order_id', 'orderId'),
+    Param('amount', 'amount', validator=_check_amount),
+    _MARKET_SEGMENT,
+))
+
+VERIFY_TRANSACTION = Operation('verifyTransaction', params=(
+    Param('transaction_id', 'transactionId'),
+    Param('transaction_order_id', 'transactionOrderId'),
+    _MARKET_SEGMENT,
+))
+
+VERIFY_CREDIT_CARD = Operation('verifyCreditCard', params=(
+    Param('credit_card_number', 'creditCardNumber',
+        validator=_check_card_number),
+    Param('expiry_date', 'expiryDate', validator=_check_expiry_date),
+    Param('zipcode', 'zip', validator=_check_zip),
+    Param('street', 'street'),
+    _MARKET_SEGMENT,
+    _AVS_REQUEST,
+    _CVV2_REQUEST,
+    _CVV_PARAM,
+))
+
+BATCH_CLOSURE = Operation('batch', 'close', params=(_MARKET_SEGMENT,))
+
+FRAUD_UPDATE = Operation('fraudUpdate', params=(
+    Param('transaction_id', 'transactionId'),
+    Param('fraud_session_id', 'fraudSessionId'),
+    Param('auth', 'auth'),
+    _MARKET_SEGMENT,
+))
+
+_STORAGE_PROFILE = (
+    Param('storage_token_id', 'storageTokenId'),
+    Param('credit_card_number', 'creditCardNumber',
+        validator=_check_card_number),
+    Param('expiry_date', 'expiryDate', validator=_check_expiry_date),
+    Param('profile_first_name', 'profileFirstName'),
+    Param('profile_last_name', 'profileLastName'),
+    Param('profile_phone_number', 'profilePhoneNumber'),
+    Param('profile_address', 'profileAddress1'),
+    Param('profile_postal', 'profilePostal'),
+    Param('profile_city', 'profileCity'),
+    Param('profile_country', 'profileCountry'),
+    _MARKET_SEGMENT,
+)
+
+STORAGE_CREATE = Operation('secureStorage', 'create', _STORAGE_PROFILE)
+STORAGE_UPDATE = Operation('secureStorage', 'update', _STORAGE_PROFILE)
+STORAGE_DELETE = Operation('secureStorage', 'delete', params=(
+    Param('storage_token_id', 'storageTokenId'),
+    _MARKET_SEGMENT,
+))
+STORAGE_QUERY = Operation('secureStorage', 'query', params=(
+    Param('storage_token_id', 'storageTokenId'),
+    _MARKET_SEGMENT,
+))
+
+_RECURRING_PLAN = (
+    Param('amount', 'amount', validator=_check_amount),
+    Param('periodic_purchase_state_code', 'periodicPurchaseStateCode'),
+    Param('periodic_purchase_schedule_type_code',
+        'periodicPurchaseScheduleTypeCode'),
+    Param('periodic_purchase_interval_length',
+        'periodicPurchaseIntervalLength'),
+    Param('order_id', 'orderId'),
+    Param('start_date', 'startDate'),
+    Param('end_date', 'endDate'),
+    Param('next_payment_date', 'nextPaymentDate'),
+    Param('customer_id', 'customerId', ''),
+    _MARKET_SEGMENT,
+    _AVS_REQUEST,
+    _CVV2_REQUEST,
+)
+
+RECURRING_CREATE = Operation('recurringPurchase', 'create', _RECURRING_PLAN,
+    card=True)
+RECURRING_UPDATE = Operation('recurringPurchase', 'update', _RECURRING_PLAN,
+    card=True)
+RECURRING_EXECUTE = Operation('recurringPurchase', 'execute', params=(
+    Param('order_id', 'orderId'),
+    Param('cvv', 'cvv2', validator=_check_cvv),
+    _MARKET_SEGMENT,
+))
+_RECURRING_STATE = (Param('order_id', 'orderId'), _MARKET_SEGMENT)
+RECURRING_HOLD = Operation('recurringPurchase', 'update', _RECURRING_STATE,
+    constants={'periodicPurchaseStateCode': 3})
+RECURRING_RESUME = Operation('recurringPurchase', 'update', _RECURRING_STATE,
+    constants={'periodicPurchaseStateCode': 1})
+RECURRING_CANCEL = Operation('recurringPurchase', 'update', _RECURRING_STATE,
+    constants={'periodicPurchaseStateCode': 4})
+
+# last_request of the clients with last_request_scope 'context', per
+# client. Context variables are never collected, so there's one for all
+# clients; the mapping is copied on each set so other contexts keep theirs
+_last_requests = contextvars.ContextVar('salt_last_requests', default=None)
 
 class Salt(object):
-    def __init__(self, apikey=None, merchant_id=None, url=None, debug=False):
+    def __init__(self, apikey=None, merchant_id=None, url=None, debug=False,
+        retry=None, timeout=None, breaker=None, limiter=None,
+        storage_cache=None, instruments=(), log_sample_rate=1.0,
+        session=None, last_request_scope='instance', validate=True,
+        rate_limiter=None, transport=None, coalesce=None, outbox=None,
+        transactions=None):
         """ initialize the API client
 
         Args:
             apikey (str): provide your Salt API key, required
             merchant_id (str): provide your Salt Merchat ID, required
+            url (str): gateway endpoint for this client, defaults to ROOT
             debug (bool): set True to log to "salt_api" logger at INFO level
+
+        Optional Args:
+            retry (RetryPolicy): retry calls failing with TimedOut or
+                NetworkError, by default they are raised straight away
+            timeout (float): seconds to wait for the gateway on each attempt,
+                no limit by default
+            breaker (CircuitBreaker): fail fast while the gateway is down
+            limiter (ConcurrencyLimiter): cap calls in flight at once
+            storage_cache (StorageQueryCache): cache SecureStorage.query
+            instruments (list): Instrument hooks run around every request
+            log_sample_rate (float): share of calls whose request and
+                response get logged, defaults to 1 (all of them)
+            session (requests.Session): share connections with other
+                clients, see SaltPool
+            transport (Transport): how requests reach the gateway, by
+                default a RequestsTransport over ``session``
+            last_request_scope (str): who sees last_request: 'instance'
+                (every user of this client), 'thread' (the calling thread)
+                or 'context' (the calling thread or asyncio task)
+            validate (bool): check card numbers, expiry dates, CVVs, zip
+                codes and amounts before sending, defaults to True
+            rate_limiter (RateLimiter): pace calls per merchant and
+                requestCode, may be shared between clients
+            coalesce (SingleFlight): share one gateway request between
+                concurrent identical transaction verifications and storage
+                queries; callers that were spared one don't see it as their
+                last_request
+            outbox (outbox.Outbox): log purchases and refunds before they
+                are sent and their outcome after, for recovery after a crash
+            transactions (TransactionIndex): keep track of purchases, their
+                batch and refunds, for reverse()
         """
 
-        self.session = requests.session()
+        if last_request_scope == 'thread':
+            self._last_request = threading.local()
+        elif last_request_scope in ('context', 'instance'):
+            self._last_request = None
+        else:
+            raise Error('Unknown last_request_scope %r' % last_request_scope)
+        self.last_request_scope = last_request_scope
+
+        self.transport = transport if transport is not None else \
+            RequestsTransport(session=session)
         self.last_request = None
+        self.retry = retry
+        self.timeout = timeout
+        self.breaker = breaker
+        self.limiter = limiter
+        self.rate_limiter = rate_limiter
+        self.coalesce = coalesce
+        self.outbox = outbox
+        self.transactions = transactions
+        self.instruments = list(instruments)
+        self.log_sample_rate = log_sample_rate
+        self.validate = validate
 
         if debug:
             self.level = logging.INFO
@@ -135,79 +1747,279 @@ class Salt(object):
         self.apikey = apikey
         self.merchant_id = merchant_id
 
-        global ROOT
         if url is None and ROOT is None:
             raise Error('You must provide a Salt API root endpoint')
 
-        if url is not None:
-            ROOT = url
+        # kept per client so clients for different endpoints can coexist;
+        # without one the module-wide ROOT is used
+        self.url = url
+
+        self.storage_cache = storage_cache
+        # the helpers are made on first use, most clients need neither
+        self._recuring_purchase = None
+        self._secure_storage = None
+
+    @property
+    def recuring_purchase(self):
+        if self._recuring_purchase is None:
+            self._recuring_purchase = RecurringPurchase(self)
+        return self._recuring_purchase
+
+    @property
+    def secure_storage(self):
+        if self._secure_storage is None:
+            self._secure_storage = SecureStorage(self, self.storage_cache)
+        return self._secure_storage
+
+    @property
+    def endpoint(self):
+        return self.url if self.url is not None else ROOT
+
+    @property
+    def session(self):
+        """ The transport's requests session, if it has one """
+        return getattr(self.transport, 'session', None)
+
+    def warm(self, connections=1):
+        """ Open connections to the gateway before the first calls need
+        them, returning how many were opened
+        """
+        return self.transport.warm(self.endpoint, connections)
 
-        self.recuring_purchase = RecurringPurchase(self)
-        self.secure_storage = SecureStorage(self)
+    @property
+    def last_request(self):
+        """ Request, response and timing of the latest call, as seen from
+        the caller per last_request_scope
+        """
+
+        scope = self.last_request_scope
+        if scope == 'thread':
+            return getattr(self._last_request, 'value', None)
+        if scope == 'context':
+            requests = _last_requests.get()
+            return requests.get(self) if requests is not None else None
+        return self._last_request
+
+    @last_request.setter
+    def last_request(self, value):
+        scope = self.last_request_scope
+        if scope == 'thread':
+            self._last_request.value = value
+        elif scope == 'context':
+            requests = _last_requests.get()
+            requests = weakref.WeakKeyDictionary(requests or ())
+            requests[self] = value
+            _last_requests.set(requests)
+        else:
+            self._last_request = value
 
     def call(self, params=None):
-        """ Actually make the API call with the given params """
+        """ Actually make the API call with the given params, retrying it
+        as the retry policy allows
+        """
 
-        if params is None: params = {}
+        coalesce = self.coalesce
+        if coalesce is not None and params is not None and (
+            params.get('requestCode'), params.get('operationCode')) in \
+            COALESCED_REQUESTS:
+            key = (self.merchant_id, self.endpoint,
+                tuple(sorted(params.items())))
+            return coalesce.do(key, lambda: self._call(params))
+
+        outbox = self.outbox
+        if outbox is not None and params is not None and outbox.wants(params):
+            return outbox.track(self.merchant_id, params,
+                lambda: self._call(params))
+        return self._call(params)
+
+    def _call(self, params):
+        if self.retry is not None:
+            return self.retry.run(self, params)
+        return self._send(params)
+
+    def _send(self, params=None, timeout=None):
+        """ Make a single attempt at the API call, subject to the rate
+        limiter, circuit breaker and concurrency limiter
+        """
 
-        params['apiToken'] = self.apikey
-        params['merchantId'] = self.merchant_id
+        rate_limiter = self.rate_limiter
+        if rate_limiter is None:
+            return self._attempt(params, timeout)
+
+        # waiting for a rate slot comes first, so callers queued here hold
+        # no concurrency slot
+        request_code = (params or {}).get('requestCode')
+        rate_limiter.acquire(self.merchant_id, request_code)
+        try:
+            return self._attempt(params, timeout)
+        except RATE_DENIALS:
+            rate_limiter.denied_call(self.merchant_id, request_code)
+            raise
+
+    def _attempt(self, params=None, timeout=None):
+        breaker, limiter = self.breaker, self.limiter
+        if breaker is None and limiter is None:
+            return self._post(params, timeout)
+
+        token = breaker.before() if breaker is not None else None
+        if limiter is not None:
+            try:
+                limiter.acquire()
+            except Overloaded:
+                # the call never went out, so it can't be the probe
+                if breaker is not None:
+                    breaker.release(token)
+                raise
 
-        self.log('POST to %s: %s' % (ROOT, params))
         start = time.time()
-        response = self.session.post(
-            ROOT,
-            data=params,
-            headers={'user-agent': 'SaltTechnologiesAPI-Python/%s' % VERSION})
+        failed = False
         try:
-            # grab the remote_addr before grabbing the text since the socket
-            # will go away
-            remote_addr = response.raw._original_response.fp._sock.getpeername()
-        except:
-            # we use two private fields when getting the remote_addr,
-            # so be a little robust against errors
-            remote_addr = (None, None)
-
-        response_body = {}
-        response_attrs = response.text.split('\n')
-        for attr in response_attrs[:-1]:
-            key, value = attr.split('=')
-            if value == 'true':
-                value = True
-            elif value == 'false':
-                value = False
-            response_body[key] = value
+            return self._post(params, timeout)
+        except GATEWAY_FAILURES:
+            failed = True
+            raise
+        finally:
+            elapsed = time.time() - start
+            if limiter is not None:
+                limiter.release(failed, elapsed)
+            if breaker is not None:
+                breaker.record(failed, elapsed, token)
+
+    def _post(self, params=None, timeout=None):
+        """ POST the params to the gateway """
+
+        params = self._prepare(params)
+        if timeout is None:
+            timeout = self.timeout
+
+        info = self._start_call(params) if self.instruments else None
+
+        endpoint = self.endpoint
+        log = self._log_call()
+        if log:
+            self.log('POST to %s: %s', endpoint, Redacted(params), extra={
+                'salt_event': 'request',
+                'salt_request_code': params.get('requestCode')})
+        start = time.time()
+        try:
+            response = self.transport.post(endpoint,
+                urlencode(params).encode('ascii'), _HEADERS, timeout)
+        except Error as e:
+            if info is not None:
+                self._fail_call(info, e)
+            raise
+
+        if info is not None:
+            info.bytes_sent = response.bytes_sent
+            info.connection_reused = response.reused
+
+        return self._handle_response(params, response.status_code,
+            response.content, response.remote_addr, start, info, log)
+
+    def _prepare(self, params):
+        """ Return a copy of the params with the merchant credentials
+        attached, the caller's dict is left alone so it can be reused and
+        shared between threads
+        """
+
+        prepared = dict(params) if params is not None else {}
+        prepared['apiToken'] = self.apikey
+        prepared['merchantId'] = self.merchant_id
+        return prepared
+
+    def _handle_response(self, params, status_code, raw, remote_addr, start,
+        info=None, log=True):
+        """ Wrap a raw gateway reply in its Receipt, record it as the last
+        request and raise the mapped exception if the gateway reported an
+        error. Shared by every transport so they all behave the same way.
+        """
+
+        receipt = RECEIPT_TYPES.get(params.get('requestCode'),
+            PurchaseReceipt)(raw)
 
         complete_time = time.time() - start
-        self.log('Received %s in %.2fms: %s' % (
-            response.status_code, complete_time * 1000, response.text))
+        if log:
+            self.log('Received %s in %.2fms: %s', status_code,
+                complete_time * 1000, Redacted(raw), extra={
+                    'salt_event': 'response',
+                    'salt_request_code': params.get('requestCode'),
+                    'salt_status': status_code,
+                    'salt_elapsed_ms': complete_time * 1000})
+        # only plain values are kept, holding on to the requests Response
+        # would keep its headers, raw stream and connection state alive too;
+        # the params without the card data and credentials, as the client
+        # may be shared
         self.last_request = {
-            'request_body': params,
-            'response_body': response.text,
+            'request_body': redact_params(params),
+            'response_body': raw,
+            'status_code': status_code,
             'remote_addr': remote_addr,
-            'response': response,
             'time': complete_time
         }
 
-        if response.status_code != requests.codes.ok or \
-            response_body['ERROR_MESSAGE'] != 'SUCCESS':
-                raise self.cast_error(response_body)
-        return response_body
+        if info is not None:
+            info.elapsed = complete_time
+            info.status_code = status_code
+            info.bytes_received = len(raw)
+            info.receipt = receipt
+            self._run_hooks('after_response', info)
+
+        if status_code != 200 or not receipt.success:
+            error = self.cast_error(receipt)
+            if info is not None:
+                self._fail_call(info, error)
+            raise error
+        return receipt
+
+    def _start_call(self, params):
+        info = CallInfo(params)
+        self._run_hooks('before_request', info)
+        return info
+
+    def _fail_call(self, info, error):
+        if info.elapsed is None:
+            info.elapsed = time.time() - info.start
+        info.error = error
+        self._run_hooks('on_error', info)
+
+    def _run_hooks(self, name, info):
+        for instrument in self.instruments:
+            try:
+                getattr(instrument, name)(info)
+            except Exception:
+                logger.exception('Instrument %r failed in %s', instrument,
+                    name)
 
     def cast_error(self, result):
         """ Take a result representing an error and cast it to a specific
         exception if possible (use a generic Error exception for unknown cases)
+        carrying the result as its receipt
         """
 
-        if result['ERROR_MESSAGE'] in ERROR_MAP:
-            return ERROR_MAP[result['ERROR_MESSAGE']](result['ERROR_MESSAGE'])
-        return Error(result['ERROR_MESSAGE'])
+        code = result.get('ERROR_MESSAGE')
+        cls = ERROR_MAP.get(code)
+        if cls is not None:
+            return cls(code, receipt=result)
+        return Error(code if code is not None else
+            'Reply without an ERROR_MESSAGE', receipt=result)
 
-    def log(self, *args, **kwargs):
+    def log(self, msg, *args, **kwargs):
         """ Proxy access to the salt_api logger, changing the level based on the
-        debug setting
+        debug setting. Pass format arguments rather than a formatted string,
+        they are only rendered if the record is emitted.
         """
-        logger.log(self.level, *args, **kwargs)
+        if logger.isEnabledFor(self.level):
+            if _handler is None:
+                _default_handler()
+            logger.log(self.level, msg, *args, **kwargs)
+
+    def _log_call(self):
+        """ Whether to log the request and response of the call starting now """
+
+        if not logger.isEnabledFor(self.level):
+            return False
+        return self.log_sample_rate >= 1 or \
+            random.random() < self.log_sample_rate
 
     def __repr__(self):
         return '<SaltAPI %s - %s>' % (self.apikey, self.merchant_id)
@@ -235,27 +2047,14 @@ class Salt(object):
             cvv2_request_code (int): defaults to 0
 
         """
-        _params = {
-            'requestCode': 'singlePurchase',
-            'amount': amount,
-            'orderId': order_id
-        }
-
-        cc_meta = _get_cc_or_id(kwargs)
-
-        _params['zip'] = kwargs.get('zip', '')
-        _params['street'] = kwargs.get('street', '')
-        _params['marketSegmentCode'] = kwargs.get('market_segment_code', 'I')
-        _params['avsRequestCode'] = kwargs.get('avs_request_code', 0)
-        _params['cvv2RequestCode'] = kwargs.get('cvv2_request_code', 0)
-
-        _params = dict(_params.items() + cc_meta.items())
-
-        self.cvv = kwargs.get('cvv', None)
-        if self.cvv:
-            _params['cvv'] = self.cvv
+        kwargs['amount'] = amount
+        kwargs['order_id'] = order_id
 
-        return self.call(_params)
+        params = SINGLE_PURCHASE.build(kwargs, self.validate)
+        receipt = self.call(params)
+        if self.transactions is not None:
+            self.transactions.add(receipt, params)
+        return receipt
 
     def void(self, transaction_id, transaction_order_id, **kwargs):
         """ Cancels a transaction, preventing it from being settled. A Void can
@@ -271,14 +2070,13 @@ class Salt(object):
 
         """
 
-        _params = {
-            'requestCode': 'void',
-            'transactionId': transaction_id,
-            'transaction_order_id': transaction_order_id,
-        }
-        _params['marketSegmentCode'] = kwargs.get('market_segment_code', 'I')
+        kwargs['transaction_id'] = transaction_id
+        kwargs['transaction_order_id'] = transaction_order_id
 
-        return self.call(_params)
+        receipt = self.call(VOID.build(kwargs, self.validate))
+        if self.transactions is not None:
+            self.transactions.voided(transaction_id)
+        return receipt
 
     def refund(self, transaction_id, transaction_order_id, order_id, amount,
         **kwargs):
@@ -297,16 +2095,89 @@ class Salt(object):
 
         """
 
-        _params = {
-            'requestCode': 'refund',
-            'transactionId': transaction_id,
-            'transactionOrderId': transaction_order_id,
-            'orderId': order_id,
-            'amount': amount
-        }
-        _params['marketSegmentCode'] = kwargs.get('market_segment_code', 'I')
+        kwargs['transaction_id'] = transaction_id
+        kwargs['transaction_order_id'] = transaction_order_id
+        kwargs['order_id'] = order_id
+        kwargs['amount'] = amount
+
+        params = REFUND.build(kwargs, self.validate)
+        index = self.transactions
+        if index is None:
+            return self.call(params)
+
+        # counted up front so concurrent refunds can't overdraw the purchase
+        index.reserve_refund(transaction_id, amount)
+        try:
+            return self.call(params)
+        except Error as e:
+            # after a timeout the refund may have gone through, keep it
+            if e.kind.category != 'gateway':
+                index.release_refund(transaction_id, amount)
+            raise
+
+    def reverse(self, transaction_id, amount=None, order_id=None, **kwargs):
+        """ Give a purchase's money back: void it while its batch is open,
+        refund it once the batch is closed. Needs a TransactionIndex that
+        saw the purchase.
+
+        Args:
+            transaction_id (int)
+
+        Optional Args:
+            amount (int): refund only part of what is left; a purchase in
+                an open batch can only be voided whole
+            order_id (str): order ID of the refund, required unless the
+                purchase can be voided; a void that turns out not to be
+                possible raises without it
+            market_segment_code (str): defaults to the purchase's
+
+        """
 
-        return self.call(_params)
+        index = self.transactions
+        if index is None:
+            raise Error('reverse() needs a TransactionIndex, see '
+                'Salt(transactions=...)')
+        purchase = index.get(transaction_id)
+        if purchase is None:
+            raise Error('Transaction %s is unknown to the index' %
+                transaction_id)
+
+        remaining = purchase.remaining
+        if remaining == 0 or (amount is not None and remaining is not None
+            and int(amount) > remaining):
+            raise PurchaseRefundAmountOverLimit(
+                'C105_PURCHASE_REFUND_AMOUNT_OVER_LIMIT')
+        # by default all that is left; a void takes back the whole purchase
+        whole = amount is None and not purchase.refunded or \
+            amount is not None and int(amount) == purchase.amount
+        if amount is None:
+            amount = remaining
+        kwargs.setdefault('market_segment_code', purchase.market_segment_code)
+
+        state = index.state(transaction_id)
+        if state == 'open' and not whole:
+            raise PurchaseNotInRefundableState(
+                'C104_PURCHASE_NOT_IN_REFUNDABLE_STATE')
+        # without its order ID a refund is neither logged by the outbox nor
+        # reconciled on retry
+        missing_order_id = 'Reversing transaction %s as a refund needs ' \
+            'an order_id' % transaction_id
+        if order_id is None and (state == 'settled' or not whole):
+            raise Error(missing_order_id)
+        if state != 'settled' and whole:
+            # near a closure the batch may have closed a moment ago or be
+            # about to, and the index can't see batches closed elsewhere
+            try:
+                return self.void(transaction_id, purchase.order_id,
+                    **kwargs)
+            except TransactionNotVoidable:
+                if order_id is None:
+                    raise Error(missing_order_id)
+        if amount is None:
+            raise Error('The amount of transaction %s is unknown, pass the '
+                'amount to refund' % transaction_id)
+        return self.refund(transaction_id, purchase.order_id, order_id,
+            amount, **kwargs)
 
     def transaction_verification(self, transaction_id, **kwargs):
         """ In certain cases when you are unsure of the results of the
@@ -314,20 +2185,18 @@ class Salt(object):
         double-check its status.
 
         Args:
-            transaction_id (int)
+            transaction_id (int): may be None when transaction_order_id is
+                given
 
         Optional Args:
+            transaction_order_id (str): look the transaction up by order ID
             market_segment_code (str): defaults to I
 
         """
 
-        _params = {
-            'requestCode': 'verifyTransaction',
-            'transactionId': transaction_id
-        }
-        _params['marketSegmentCode'] = kwargs.get('market_segment_code', 'I')
+        kwargs['transaction_id'] = transaction_id
 
-        return self.call(_params)
+        return self.call(VERIFY_TRANSACTION.build(kwargs, self.validate))
 
     def credit_card_verification(self, credit_card_number, expiry_date, zipcode,
         street, **kwargs):
@@ -350,21 +2219,12 @@ class Salt(object):
 
         """
 
-        _params = {
-            'requestCode': 'verifyCreditCard',
-            'creditCardNumber': credit_card_number,
-            'expiryDate': expiry_date,
-            'zip': zipcode,
-            'street': street,
-        }
-        _params['marketSegmentCode'] = kwargs.get('market_segment_code', 'I')
-        _params['avsRequestCode'] = kwargs.get('avs_request_code', 0)
-        _params['cvv2RequestCode'] = kwargs.get('cvv2_request_code', 0)
-        self.cvv = kwargs.get('cvv', None)
-        if self.cvv:
-            _params['cvv'] = self.cvv
+        kwargs['credit_card_number'] = credit_card_number
+        kwargs['expiry_date'] = expiry_date
+        kwargs['zipcode'] = zipcode
+        kwargs['street'] = street
 
-        return self.call(_params)
+        return self.call(VERIFY_CREDIT_CARD.build(kwargs, self.validate))
 
     def batch_closure(self, **kwargs):
         """ All batches are closed automatically every night at 12:00 am EST.
@@ -377,13 +2237,10 @@ class Salt(object):
 
         """
 
-        _params = {
-            'requestCode': 'batch',
-            'operationCode': 'close'
-        }
-        _params['marketSegmentCode'] = kwargs.get('market_segment_code', 'I')
-
-        return self.call(_params)
+        receipt = self.call(BATCH_CLOSURE.build(kwargs, self.validate))
+        if self.transactions is not None:
+            self.transactions.close_batch()
+        return receipt
 
     def fraud(self, transaction_id, fraud_session_id, auth, **kwargs):
         """ Allow merchants to update fraud AUTH status if they use other
@@ -399,15 +2256,453 @@ class Salt(object):
 
         """
 
-        _params = {
-            'requestCode': 'fraudUpdate',
-            'transactionId': transaction_id,
-            'fraudSessionId': fraud_session_id,
-            'auth': auth
-        }
-        _params['marketSegmentCode'] = kwargs.get('market_segment_code', 'I')
+        kwargs['transaction_id'] = transaction_id
+        kwargs['fraud_session_id'] = fraud_session_id
+        kwargs['auth'] = auth
+
+        return self.call(FRAUD_UPDATE.build(kwargs, self.validate))
+
+    # Bulk submission
+    def submit_many(self, requests, max_in_flight=10):
+        """ Run many operations concurrently on a thread pool, yielding a
+        BatchResult for each one in completion order.
+
+        Each request is a tuple of (operation, kwargs) or
+        (operation, args, kwargs), where operation names a method of this
+        client, dotted for the helpers, or is any callable making calls of
+        its own:
+
+            specs = (('recuring_purchase.execute', {'order_id': o, 'cvv': c})
+                     for o, c in renewals)
+            for result in salt.submit_many(specs, max_in_flight=20):
+                if not result.ok:
+                    failed.append(result)
+
+        A failing operation does not stop the batch; its exception is put on
+        the result instead. ``requests`` may be a generator, it is only read
+        as fast as slots free up so at most ``max_in_flight`` operations are
+        pending at any time.
+
+        Args:
+            requests (iterable): operation specs as described above
+
+        Optional Args:
+            max_in_flight (int): concurrent gateway calls, defaults to 10
+
+        """
+
+        import concurrent.futures
+
+        if max_in_flight < 1: raise Error('max_in_flight must be at least 1')
+        self.transport.ensure_pool_size(self.endpoint, max_in_flight)
+
+        specs = enumerate(requests)
+        pending = {}
+        with concurrent.futures.ThreadPoolExecutor(max_in_flight) as pool:
+            try:
+                while True:
+                    for index, spec in specs:
+                        operation, args, kwargs = _unpack_spec(spec)
+                        future = pool.submit(self._run_spec, operation, args,
+                            kwargs)
+                        pending[future] = (index, operation)
+                        if len(pending) >= max_in_flight:
+                            break
+
+                    if not pending:
+                        return
+
+                    done, _ = concurrent.futures.wait(pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        index, operation = pending.pop(future)
+                        try:
+                            receipt = future.result()
+                        except Exception as e:
+                            yield BatchResult(index, operation, error=e)
+                        else:
+                            yield BatchResult(index, operation, receipt)
+            finally:
+                # the consumer stopped early; don't start anything still queued
+                for future in pending:
+                    future.cancel()
+
+    def _run_spec(self, operation, args, kwargs):
+        if callable(operation):
+            return operation(*args, **kwargs)
+        target = self
+        for name in operation.split('.'):
+            target = getattr(target, name)
+        return target(*args, **kwargs)
+
+def _unpack_spec(spec):
+    if len(spec) == 2:
+        operation, kwargs = spec
+        return operation, (), kwargs
+    operation, args, kwargs = spec
+    return operation, tuple(args), kwargs
+
+class SaltPool(object):
+    """ Clients for many merchants over one shared connection pool.
+
+        pool = SaltPool(url, pool_size=50, timeout=10)
+        pool.add('merchant-1', 'apikey-1')
+        pool.add('merchant-2', 'apikey-2')
+        pool['merchant-2'].single_purchase(...)
+
+    Every client is a regular Salt sharing the pool's transport, so they
+    reuse the same sockets to the gateway whatever merchant a call is for.
+    Extra keyword arguments are passed on to each Salt; instances given that
+    way (a CircuitBreaker, say) are shared by all merchants.
+    """
+
+    def __init__(self, url=None, pool_size=10, transport=None,
+        **client_options):
+        self.url = url
+        self.transport = transport if transport is not None else \
+            RequestsTransport(pool_size)
+        self.client_options = client_options
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def add(self, merchant_id, apikey, url=None, **client_options):
+        """ Register a merchant, replacing any previous credentials, and
+        return its client
+        """
+
+        options = dict(self.client_options, **client_options)
+        client = Salt(apikey, merchant_id, url if url is not None else self.url,
+            transport=self.transport, **options)
+        with self._lock:
+            self._clients[merchant_id] = client
+        return client
+
+    def remove(self, merchant_id):
+        with self._lock:
+            self._clients.pop(merchant_id, None)
+
+    def __getitem__(self, merchant_id):
+        try:
+            return self._clients[merchant_id]
+        except KeyError:
+            raise Error('Unknown merchant %s' % merchant_id)
+
+    def __contains__(self, merchant_id):
+        return merchant_id in self._clients
+
+    def __len__(self):
+        return len(self._clients)
+
+    def call(self, merchant_id, params=None):
+        """ Make a raw API call as the given merchant """
+        return self[merchant_id].call(params)
+
+    def close(self):
+        self.transport.close()
+
+# fields of a secure storage query that may be kept outside the gateway;
+# anything else (names, address, phone) is dropped before caching and card
+# numbers are masked down to their last four digits
+CACHEABLE_STORAGE_FIELDS = frozenset([
+    'ERROR_MESSAGE',
+    'STORAGE_TOKEN_ID',
+    'CREDIT_CARD_NUMBER',
+    'EXPIRY_DATE',
+    'CARD_TYPE',
+])
+
+class CacheBackend(object):
+    """ Storage for cached query replies. Keys are str, values bytes.
+
+    Subclass this to share the cache between processes (memcached, redis,
+    ...); implementations must be safe to use from several threads.
+    """
+
+    def get(self, key):
+        """ Return the cached value or None if missing or expired """
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        """ Store value for ttl seconds """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """ Drop the key if present """
+        raise NotImplementedError
+
+class LRUCacheBackend(CacheBackend):
+    """ In-process CacheBackend keeping the ``maxsize`` most recently used
+    entries
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+class StorageQueryCache(object):
+    """ Opt-in cache of SecureStorage.query replies.
+
+    Only CACHEABLE_STORAGE_FIELDS are kept, so a cached receipt carries the
+    masked card and expiry but none of the profile details. Entries live for
+    ``ttl`` seconds in ``backend`` (an LRUCacheBackend by default) and are
+    dropped whenever the same token is updated or deleted through the
+    client. Queries answered by the gateway get the same filtered receipt
+    as those answered from the cache.
+    """
+
+    def __init__(self, backend=None, ttl=300):
+        self.backend = backend if backend is not None else LRUCacheBackend()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # bumped by invalidate(), so a query sent before an update can't
+        # cache the old record after it
+        self._generations = collections.Counter()
+
+    def key(self, merchant_id, storage_token_id):
+        return 'salt:storage:%s:%s' % (merchant_id, storage_token_id)
+
+    def get(self, key):
+        raw = self.backend.get(key)
+        with self._lock:
+            if raw is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if raw is None:
+            return None
+        return StorageReceipt(raw)
+
+    def generation(self, key):
+        """ Pass to set() what this returned before the query was sent """
+        with self._lock:
+            return self._generations[key]
+
+    def set(self, key, receipt, generation=None):
+        """ Cache the fields of ``receipt`` worth keeping, unless ``key`` was
+        invalidated since ``generation``, and return them as the receipt
+        """
 
-        return self.call(_params)
+        lines = []
+        for name, value in receipt.items():
+            if name not in CACHEABLE_STORAGE_FIELDS:
+                continue
+            if value is True or value is False:
+                value = 'true' if value else 'false'
+            elif name == 'CREDIT_CARD_NUMBER':
+                value = '*' * max(len(value) - 4, 0) + value[-4:]
+            lines.append('%s=%s\n' % (name, value))
+        raw = ''.join(lines).encode(RESPONSE_ENCODING)
+        with self._lock:
+            current = generation is None or \
+                generation == self._generations[key]
+        if current:
+            self.backend.set(key, raw, self.ttl)
+        return StorageReceipt(raw)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generations[key] += 1
+        self.backend.delete(key)
+
+# batches are closed automatically every night at 12:00 am Eastern time;
+# looked up on first use, with EST all year round if there is no tz data
+_EASTERN = None
+
+def _eastern():
+    global _EASTERN
+    if _EASTERN is None:
+        import datetime
+        try:
+            from zoneinfo import ZoneInfo
+            _EASTERN = ZoneInfo('America/New_York')
+        except Exception:
+            _EASTERN = datetime.timezone(datetime.timedelta(hours=-5))
+    return _EASTERN
+
+def _last_daily_closure(now):
+    """ time.time() of the latest automatic batch closure up to ``now`` """
+
+    import datetime
+    local = datetime.datetime.fromtimestamp(now, _eastern())
+    return local.replace(hour=0, minute=0, second=0,
+        microsecond=0).timestamp()
+
+class _Purchase(object):
+    __slots__ = ('transaction_id', 'order_id', 'amount', 'refunded', 'time',
+        'batch', 'voided', 'market_segment_code')
+
+    def __init__(self, transaction_id, order_id, amount, time, batch,
+        market_segment_code):
+        self.transaction_id = transaction_id
+        self.order_id = order_id
+        self.amount = amount
+        self.refunded = 0
+        self.time = time
+        self.batch = batch
+        self.voided = False
+        self.market_segment_code = market_segment_code
+
+    @property
+    def remaining(self):
+        """ Amount that may still be refunded, None if the purchase
+        amount is unknown
+        """
+
+        if self.voided:
+            return 0
+        if self.amount is None:
+            return None
+        return self.amount - self.refunded
+
+class TransactionIndex(object):
+    """ Opt-in record of the purchases made through a client, so that
+    Salt.reverse() knows whether a purchase can still be voided or has to
+    be refunded, and refunds over the purchased amount are refused without
+    asking the gateway.
+
+    Purchases are added from single_purchase and RecurringPurchase.execute
+    receipts and belong to the batch open at the time. That batch is closed
+    by batch_closure through any client sharing the index, or at the daily
+    closure. An index covers one merchant account and only sees calls made
+    through its clients: a batch closed from elsewhere is only noticed at
+    the next daily closure, until then reverse() tries a void and falls
+    back to a refund when the gateway says it is too late.
+
+    Optional Args:
+        capacity (int): purchases remembered, the oldest are forgotten
+            first; defaults to 100000
+        margin (float): seconds either side of the daily closure during
+            which clocks may disagree on the batch; defaults to 300
+        daily_closure (callable): time of the latest automatic closure for a
+            time.time() value, defaults to midnight Eastern time
+    """
+
+    def __init__(self, capacity=100000, margin=300.0, daily_closure=None):
+        self.capacity = capacity
+        self.margin = margin
+        self.daily_closure = daily_closure if daily_closure is not None \
+            else _last_daily_closure
+        # bumped by each manual batch closure
+        self.batch = 0
+        self._purchases = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._purchases)
+
+    def __contains__(self, transaction_id):
+        return str(transaction_id) in self._purchases
+
+    def get(self, transaction_id):
+        return self._purchases.get(str(transaction_id))
+
+    def add(self, receipt, params):
+        """ Record the purchase ``receipt`` answered for request ``params``.
+        This runs once the gateway has charged, so it never raises: a
+        purchase whose amount can't be told (recurring executes don't send
+        one) is kept with an amount of None and its refunds go unchecked.
+        """
+
+        transaction_id = receipt.get('TRANSACTION_ID')
+        if transaction_id is None:
+            return
+        amount = receipt.get('APPROVED_AMOUNT') or receipt.get('AMOUNT') or \
+            params.get('amount')
+        try:
+            amount = int(amount)
+        except (TypeError, ValueError):
+            amount = None
+        purchase = _Purchase(str(transaction_id),
+            receipt.get('ORDER_ID') or params.get('orderId'), amount,
+            time.time(), self.batch, params.get('marketSegmentCode', 'I'))
+        with self._lock:
+            self._purchases[purchase.transaction_id] = purchase
+            while len(self._purchases) > self.capacity:
+                self._purchases.popitem(last=False)
+
+    def voided(self, transaction_id):
+        purchase = self.get(transaction_id)
+        if purchase is not None:
+            purchase.voided = True
+
+    def close_batch(self):
+        with self._lock:
+            self.batch += 1
+
+    def reserve_refund(self, transaction_id, amount):
+        """ Count ``amount`` as refunded, raising
+        PurchaseRefundAmountOverLimit if that goes over the purchase amount.
+        Unknown transactions are left for the gateway to judge.
+        """
+
+        purchase = self.get(transaction_id)
+        if purchase is None:
+            return
+        amount = int(amount)
+        with self._lock:
+            remaining = purchase.remaining
+            if remaining is not None and amount > remaining:
+                raise PurchaseRefundAmountOverLimit(
+                    'C105_PURCHASE_REFUND_AMOUNT_OVER_LIMIT')
+            purchase.refunded += amount
+
+    def release_refund(self, transaction_id, amount):
+        """ Undo reserve_refund() for a refund the gateway turned down """
+
+        purchase = self.get(transaction_id)
+        if purchase is not None:
+            with self._lock:
+                purchase.refunded -= int(amount)
+
+    def state(self, transaction_id, now=None):
+        """ 'open' while the purchase's batch is, 'settled' once it is closed,
+        'unsure' close to a daily closure, or None for an unknown purchase
+        """
+
+        purchase = self.get(transaction_id)
+        if purchase is None:
+            return None
+        if purchase.batch != self.batch:
+            return 'settled'
+
+        if now is None:
+            now = time.time()
+        closure = self.daily_closure(now)
+        # 25 hours on is past the next closure even on a 23 hour day, and
+        # not past the one after on a 25 hour day
+        next_closure = self.daily_closure(closure + 90000)
+        margin = self.margin
+        if purchase.time < closure - margin:
+            return 'settled'
+        if purchase.time <= closure + margin or \
+            now >= next_closure - margin:
+            return 'unsure'
+        return 'open'
 
 class SecureStorage(object):
     """ With the Secure Storage API, merchants can remotely store credit card
@@ -420,43 +2715,22 @@ class SecureStorage(object):
     credit card verification.
     """
 
-    def __init__(self, master):
+    def __init__(self, master, cache=None):
         self.master = master
+        self.cache = cache
+
+    def _cache_key(self, storage_token_id):
+        return self.cache.key(self.master.merchant_id, storage_token_id)
 
     def _get_params(self, action, storage_token_id, credit_card_number, expiry_date,
         kwargs):
-        _params = {
-            'requestCode': 'secureStorage',
-            'operationCode': action,
-            'storageTokenId': storage_token_id,
-            'creditCardNumber': credit_card_number,
-            'expiryDate': expiry_date,
-        }
-
-        if 'profile_first_name' in kwargs:
-            _params['profileFirstName'] = kwargs['profile_first_name']
-
-        if 'profile_last_name' in kwargs:
-            _params['profileLastName'] = kwargs['profile_last_name']
-
-        if 'profile_phone_number' in kwargs:
-            _params['profilePhoneNumber'] = kwargs['profile_phone_number']
-
-        if 'profile_address' in kwargs:
-            _params['profileAddress1'] = kwargs['profile_address']
+        operation = STORAGE_CREATE if action == 'create' else STORAGE_UPDATE
 
-        if 'profile_postal' in kwargs:
-            _params['profilePostal'] = kwargs['profile_postal']
+        kwargs['storage_token_id'] = storage_token_id
+        kwargs['credit_card_number'] = credit_card_number
+        kwargs['expiry_date'] = expiry_date
 
-        if 'profile_city' in kwargs:
-            _params['profileCity'] = kwargs['profile_city']
-
-        if 'profile_country' in kwargs:
-            _params['profileCoutry'] = kwargs['profile_country']
-
-        _params['marketSegmentCode'] = kwargs.get('market_segment_code', 'I')
-
-        return _params
+        return operation.build(kwargs, self.master.validate)
 
     def create(self, storage_token_id, credit_card_number, expiry_date,
         **kwargs):
@@ -489,30 +2763,49 @@ class SecureStorage(object):
         """ Update a storage profile """
         _params = self._get_params('update', storage_token_id, credit_card_number, expiry_date,
             kwargs)
-        return self.master.call(_params)
+        return self._call_and_invalidate(storage_token_id, _params)
 
     def delete(self, storage_token_id, *args, **kwargs):
         """ Delete a storage profile """
-        _params = {
-            'requestCode': 'secureStorage',
-            'operationCode': 'delete',
-            'storageTokenId': storage_token_id,
-        }
+        kwargs['storage_token_id'] = storage_token_id
+        _params = STORAGE_DELETE.build(kwargs, self.master.validate)
 
-        _params['marketSegmentCode'] = kwargs.get('market_segment_code', 'I')
+        return self._call_and_invalidate(storage_token_id, _params)
 
-        return self.master.call(_params)
+    def _call_and_invalidate(self, storage_token_id, _params):
+        if self.cache is None:
+            return self.master.call(_params)
+
+        try:
+            return self.master.call(_params)
+        finally:
+            # even a failed call may have changed the record; a query sent
+            # before this point sees the generation moved and doesn't cache
+            self.cache.invalidate(self._cache_key(storage_token_id))
 
     def query(self, storage_token_id, *args, **kwargs):
-        _params = {
-            'requestCode': 'secureStorage',
-            'operationCode': 'query',
-            'storageTokenId': storage_token_id,
-        }
+        """ Query a storage profile
 
-        _params['marketSegmentCode'] = kwargs.get('market_segment_code', 'I')
+        Optional Args:
+            market_segment_code (str): defaults to I
+            refresh (bool): skip the cache and fetch from the gateway
 
-        return self.master.call(_params)
+        """
+        refresh = kwargs.pop('refresh', False)
+        kwargs['storage_token_id'] = storage_token_id
+        _params = STORAGE_QUERY.build(kwargs, self.master.validate)
+
+        if self.cache is None:
+            return self.master.call(_params)
+
+        key = self._cache_key(storage_token_id)
+        if not refresh:
+            receipt = self.cache.get(key)
+            if receipt is not None:
+                return receipt
+
+        generation = self.cache.generation(key)
+        return self.cache.set(key, self.master.call(_params), generation)
 
 class RecurringPurchase(object):
     """ You can use SALT's Recurring Payment feature when the customer is
@@ -523,46 +2816,16 @@ class RecurringPurchase(object):
     def __init__(self, master):
         self.master = master
 
-    def _create_update_params(amount, periodic_purchase_state_code,
-        periodic_purchase_schedule_type_code, periodic_purchase_interval_length,
-        order_id, start_date, end_date, next_payment_date,
-        credit_card_number, expiry_date, kws):
-
-        _params = {
-            'requestCode': 'recurringPurchase',
-            'operationCode': 'create',
-            'amount': amount,
-            'periodicPurchaseStateCode': periodic_purchase_state_code,
-            'periodicPurchaseScheduleTypeCode':
-                periodic_purchase_schedule_type_code,
-            'periodicPurchaseIntervalLength': periodic_purchase_interval_length,
-            'orderId': order_id,
-            'startDate': start_date,
-            'endDate': end_date,
-            'nextPaymentDate': next_payment_date,
-        }
-
-        _params['customerId'] = kws.get('customer_id', '')
-        _params['marketSegmentCode'] = kws.get('market_segment_code', 'I')
-        _params['avsRequestCode'] = kws.get('avs_request_code', 0)
-        _params['cvv2RequestCode'] = kws.get('cvv2_request_code', 0)
-
-        cc_meta = _get_cc_or_id(kws)
-        _params = dict(_params.items() + cc_meta.items())
-
-        return _params
-
     def create(self, amount, periodic_purchase_state_code,
         periodic_purchase_schedule_type_code, periodic_purchase_interval_length,
         order_id, start_date, end_date, next_payment_date,
         credit_card_number, expiry_date, **kwargs):
 
-        _params = self._create_update_params(amount,
+        _params = _recurring_params(RECURRING_CREATE, amount,
             periodic_purchase_state_code, periodic_purchase_schedule_type_code,
             periodic_purchase_interval_length, order_id, start_date, end_date,
-            next_payment_date, credit_card_number, expiry_date, kwargs)
-
-        _params['operationCode'] = 'create'
+            next_payment_date, credit_card_number, expiry_date, kwargs,
+            self.master.validate)
 
         return self.master.call(_params)
 
@@ -571,59 +2834,60 @@ class RecurringPurchase(object):
         order_id, start_date, end_date, next_payment_date,
         credit_card_number, expiry_date, **kwargs):
 
-        _params = self._create_update_params(amount,
+        _params = _recurring_params(RECURRING_UPDATE, amount,
             periodic_purchase_state_code, periodic_purchase_schedule_type_code,
             periodic_purchase_interval_length, order_id, start_date, end_date,
-            next_payment_date, credit_card_number, expiry_date, kwargs)
-
-        _params['operationCode'] = 'update'
+            next_payment_date, credit_card_number, expiry_date, kwargs,
+            self.master.validate)
 
         return self.master.call(_params)
 
     def execute(self, order_id, cvv, **kwargs):
-        _params = {
-            'requestCode': 'recurringPurchase',
-            'operationCode': 'execute',
-            'orderId': order_id,
-            'cvv2': cvv
-        }
+        kwargs['order_id'] = order_id
+        kwargs['cvv'] = cvv
 
-        _params['marketSegmentCode'] = kwargs.get('market_segment_code', 'I')
-
-        return self.master.call(_params)
+        params = RECURRING_EXECUTE.build(kwargs, self.master.validate)
+        receipt = self.master.call(params)
+        if self.master.transactions is not None:
+            self.master.transactions.add(receipt, params)
+        return receipt
 
     def hold(self, order_id, **kwargs):
-        _params = {
-            'requestCode': 'recurringPurchase',
-            'operationCode': 'update',
-            'orderId': order_id,
-            'periodicPurchaseStateCode': 3
-        }
+        kwargs['order_id'] = order_id
 
-        _params['marketSegmentCode'] = kwargs.get('market_segment_code', 'I')
-
-        return self.master.call(_params)
+        return self.master.call(RECURRING_HOLD.build(kwargs,
+            self.master.validate))
 
     def resume(self, order_id, **kwargs):
-        _params = {
-            'requestCode': 'recurringPurchase',
-            'operationCode': 'update',
-            'orderId': order_id,
-            'periodicPurchaseStateCode': 1
-        }
+        kwargs['order_id'] = order_id
 
-        _params['marketSegmentCode'] = kwargs.get('market_segment_code', 'I')
-
-        return self.master.call(_params)
+        return self.master.call(RECURRING_RESUME.build(kwargs,
+            self.master.validate))
 
     def cancel(self, order_id, **kwargs):
-        _params = {
-            'requestCode': 'recurringPurchase',
-            'operationCode': 'update',
-            'orderId': order_id,
-            'periodicPurchaseStateCode': 4
-        }
-
-        _params['marketSegmentCode'] = kwargs.get('market_segment_code', 'I')
-
-        return self.master.call(_params)
+        kwargs['order_id'] = order_id
+
+        return self.master.call(RECURRING_CANCEL.build(kwargs,
+            self.master.validate))
+
+def _recurring_params(operation, amount, periodic_purchase_state_code,
+    periodic_purchase_schedule_type_code, periodic_purchase_interval_length,
+    order_id, start_date, end_date, next_payment_date, credit_card_number,
+    expiry_date, kws, validate):
+
+    kws['amount'] = amount
+    kws['periodic_purchase_state_code'] = periodic_purchase_state_code
+    kws['periodic_purchase_schedule_type_code'] = \
+        periodic_purchase_schedule_type_code
+    kws['periodic_purchase_interval_length'] = periodic_purchase_interval_length
+    kws['order_id'] = order_id
+    kws['start_date'] = start_date
+    kws['end_date'] = end_date
+    kws['next_payment_date'] = next_payment_date
+    # the card may also come as storage_token_id in kws
+    if credit_card_number is not None:
+        kws['credit_card_number'] = credit_card_number
+    if expiry_date is not None:
+        kws['expiry_date'] = expiry_date
+
+    return operation.build(kws, validate)
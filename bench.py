@@ -0,0 +1,842 @@
+""" Microbenchmarks for the client-side cost of the API
+
+Run a benchmark by name, from the directory containing this package:
+
+    python -m <package>.bench parse
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import cProfile
+import gc
+import io
+import json
+import logging
+import os
+import pstats
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+from . import api
+from .billing import BillingRun
+from .fraudqueue import FraudUpdateQueue
+from .outbox import Outbox
+from .replay import RecordingTransport, Replay
+from .stub import StubGateway, latency_distribution
+
+# receipts shaped like real gateway replies, one per response family
+RECEIPTS = {
+    'purchase': (
+        b'ERROR_MESSAGE=SUCCESS\n'
+        b'APPROVED=true\n'
+        b'TRANSACTION_ID=20160301123456\n'
+        b'ORDER_ID=order-2016-000123\n'
+        b'APPROVAL_CODE=T12345\n'
+        b'AMOUNT=1999\n'
+        b'APPROVED_AMOUNT=1999\n'
+        b'AVS_RESPONSE_CODE=Y\n'
+        b'CVV2_RESPONSE_CODE=M\n'
+        b'REFERENCE_NUMBER=660148420010010510\n'
+        b'PROCESSED_DATE_TIME=2016-03-01 12:34:56\n'
+        b'RESPONSE_CODE=1\n'
+        b'MESSAGE=APPROVED\n'
+    ),
+    'declined': (
+        b'ERROR_MESSAGE=C005_DECLINED\n'
+        b'APPROVED=false\n'
+        b'TRANSACTION_ID=20160301123457\n'
+        b'ORDER_ID=order-2016-000124\n'
+        b'RESPONSE_CODE=51\n'
+        b'MESSAGE=DECLINED\n'
+    ),
+    'storage': (
+        b'ERROR_MESSAGE=SUCCESS\n'
+        b'STORAGE_TOKEN_ID=cust-000042\n'
+        b'CREDIT_CARD_NUMBER=************4242\n'
+        b'EXPIRY_DATE=1812\n'
+        b'PROFILE_FIRST_NAME=Jane\n'
+        b'PROFILE_LAST_NAME=Doe\n'
+        b'PROFILE_POSTAL=K1K1K1\n'
+        b'PROFILE_CITY=Ottawa\n'
+        b'PROFILE_COUNTRY=CA\n'
+    ),
+    'recurring': (
+        b'ERROR_MESSAGE=SUCCESS\n'
+        b'APPROVED=true\n'
+        b'TRANSACTION_ID=20160301123458\n'
+        b'ORDER_ID=sub-000042\n'
+        b'AMOUNT=999\n'
+        b'PERIODIC_PURCHASE_STATE_CODE=1\n'
+        b'PERIODIC_PURCHASE_INSTALLMENT_COUNT=12\n'
+        b'NEXT_PAYMENT_DATE=160401\n'
+    ),
+}
+
+def _legacy_parse(raw):
+    # the loop Salt.call used before parse_response, kept for comparison
+    response_body = {}
+    response_attrs = raw.decode(api.RESPONSE_ENCODING).split('\n')
+    for attr in response_attrs[:-1]:
+        key, value = attr.split('=')
+        if value == 'true':
+            value = True
+        elif value == 'false':
+            value = False
+        response_body[key] = value
+    return response_body
+
+def _time(func, number, repeat):
+    """ Best of ``repeat`` runs, in nanoseconds per call """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e9
+
+def _report(name, *columns):
+    print('%-28s' % name + ''.join('%16s' % c for c in columns))
+
+def bench_outbox(args):
+    """ per-call cost of the write-ahead outbox, one thread and many """
+
+    count = max(args.number // 20, 1)
+    _report('outbox (%d calls)' % count, 'threads', 'us/call', 'calls/sync')
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, sync in (('none', None), ('no fsync', False),
+            ('fsync', True)):
+            for threads in (1, args.concurrency):
+                outbox = None if sync is None else Outbox(
+                    os.path.join(tmp, '%s-%d' % (label, threads)), sync)
+                client = _offline_client(RECEIPTS['purchase'], outbox=outbox)
+                start = time.time()
+                with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+                    list(pool.map(lambda i: _purchase(client), range(count)))
+                elapsed = time.time() - start
+                per_sync = '-'
+                if outbox is not None:
+                    outbox.close()
+                    per_sync = '%.1f' % (outbox.records / 2.0 /
+                        outbox.batches)
+                _report(label, threads, '%.1f' % (elapsed / count * 1e6),
+                    per_sync)
+
+def bench_parse(args):
+    """ parse_response against the old split loop """
+
+    _report('receipt', 'legacy ns/op', 'parse ns/op', 'typed ns/op')
+    for name, raw in sorted(RECEIPTS.items()):
+        assert _legacy_parse(raw) == api.parse_response(raw)
+
+        legacy = _time(lambda: _legacy_parse(raw), args.number, args.repeat)
+        parsed = _time(lambda: api.parse_response(raw), args.number,
+            args.repeat)
+        body = api.parse_response(raw)
+        typed = _time(lambda: body.typed('TRANSACTION_ID'), args.number,
+            args.repeat)
+        _report(name, '%.0f' % legacy, '%.0f' % parsed, '%.0f' % typed)
+
+def _legacy_purchase_params(amount, order_id, kwargs):
+    # how Salt.single_purchase built its params before Operation schemas
+    params = {
+        'requestCode': 'singlePurchase',
+        'amount': amount,
+        'orderId': order_id
+    }
+    if kwargs.get('storage_token_id'):
+        cc_meta = {'storageTokenId': kwargs['storage_token_id']}
+    else:
+        cc_meta = {'creditCardNumber': kwargs.get('credit_card_number'),
+            'expiryDate': kwargs.get('expiry_date')}
+    params['zip'] = kwargs.get('zip', '')
+    params['street'] = kwargs.get('street', '')
+    params['marketSegmentCode'] = kwargs.get('market_segment_code', 'I')
+    params['avsRequestCode'] = kwargs.get('avs_request_code', 0)
+    params['cvv2RequestCode'] = kwargs.get('cvv2_request_code', 0)
+    params.update(cc_meta)
+    cvv = kwargs.get('cvv', None)
+    if cvv:
+        params['cvv'] = cvv
+    return params
+
+def bench_build(args):
+    """ Per-request param building: the old dict code against the schemas """
+
+    card = {'credit_card_number': 4242424242424242, 'expiry_date': 1812,
+        'cvv': 123, 'zip': '90210'}
+    token = {'storage_token_id': 'token-1'}
+
+    _report('request', 'legacy ns/op', 'build ns/op', 'validate ns/op')
+    for name, kwargs in (('purchase card', card), ('purchase token', token)):
+        values = dict(kwargs, amount=100, order_id='order-1')
+        assert _legacy_purchase_params(100, 'order-1', kwargs) == \
+            api.SINGLE_PURCHASE.build(values)
+
+        legacy = _time(lambda: _legacy_purchase_params(100, 'order-1',
+            kwargs), args.number, args.repeat)
+        build = _time(lambda: api.SINGLE_PURCHASE.build(values, False),
+            args.number, args.repeat)
+        validate = _time(lambda: api.SINGLE_PURCHASE.build(values),
+            args.number, args.repeat)
+        _report(name, '%.0f' % legacy, '%.0f' % build, '%.0f' % validate)
+
+def _legacy_result(raw):
+    # what Salt.call used to keep per call: the parsed dict plus a
+    # requests.Response held by last_request
+    import requests
+
+    response = requests.models.Response()
+    response.status_code = 200
+    response._content = raw
+    response.headers = requests.structures.CaseInsensitiveDict({
+        'Content-Type': 'text/plain', 'Content-Length': str(len(raw))})
+    response.url = api.ROOT
+    response.encoding = api.RESPONSE_ENCODING
+    return _legacy_parse(raw), response
+
+def _receipt_result(raw, parse=False):
+    # what Salt.call keeps now: success is always checked, the fields only
+    # get parsed if something reads them
+    receipt = api.PurchaseReceipt(raw)
+    receipt.success
+    if parse:
+        receipt.fields
+    return receipt
+
+def _retained(build, count):
+    """ Bytes and gc-tracked objects retained by ``count`` results """
+
+    gc.collect()
+    tracked = len(gc.get_objects())
+    tracemalloc.start()
+    kept = [build() for i in range(count)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    tracked = len(gc.get_objects()) - tracked
+    del kept
+    return size / count, tracked / count
+
+def bench_memory(args):
+    """ memory kept per result: Receipt against dict plus Response """
+
+    count = max(args.number // 10, 1)
+    _report('result', 'bytes/result', 'gc objs/result')
+    for name, raw in sorted(RECEIPTS.items()):
+        # copy the bytes so every result owns its body like a real reply
+        builders = (
+            ('dict+Response', lambda: _legacy_result(bytes(bytearray(raw)))),
+            ('Receipt', lambda: _receipt_result(bytes(bytearray(raw)))),
+            ('Receipt, parsed',
+                lambda: _receipt_result(bytes(bytearray(raw)), parse=True)),
+        )
+        for label, build in builders:
+            size, tracked = _retained(build, count)
+            _report('%s %s' % (name, label), '%.0f' % size, '%.1f' % tracked)
+
+def _operations():
+    """ (name, callable) per public operation, each isolating one step of
+    a call or running one end to end on an in-memory transport
+    """
+
+    client = _offline_client(RECEIPTS['purchase'])
+    declined = _offline_client(RECEIPTS['declined'])
+    storage = _offline_client(RECEIPTS['storage']).secure_storage
+    logged = _offline_client(RECEIPTS['purchase'], debug=True)
+
+    card = {'credit_card_number': 4242424242424242, 'expiry_date': 1812}
+    purchase = dict(card, amount=1999, order_id='order-2016-000123', cvv=123)
+    profile = {'profile_first_name': 'Jane', 'profile_last_name': 'Doe',
+        'profile_postal': 'K1K1K1', 'profile_country': 'CA'}
+    params = api.SINGLE_PURCHASE.build(purchase)
+    declined_receipt = api.PurchaseReceipt(RECEIPTS['declined'])
+
+    def decline():
+        try:
+            declined.call(params)
+        except api.Declined:
+            pass
+
+    return (
+        ('build single_purchase',
+            lambda: api.SINGLE_PURCHASE.build(purchase)),
+        ('_add_card', lambda: api._add_card({}, card, True)),
+        ('SecureStorage._get_params', lambda: storage._get_params('create',
+            'cust-000042', 4242424242424242, 1812, dict(profile))),
+        ('parse purchase',
+            lambda: api.PurchaseReceipt(RECEIPTS['purchase']).fields),
+        ('cast_error', lambda: client.cast_error(declined_receipt)),
+        ('call', lambda: client.call(params)),
+        ('call, declined', decline),
+        ('call, logged', lambda: logged.call(params)),
+        ('single_purchase', lambda: _purchase(client)),
+        ('SecureStorage.query', lambda: storage.query('cust-000042')),
+    )
+
+def _memory(func, number):
+    """ Peak bytes allocated by one call and bytes still held per call
+    after ``number`` of them, under tracemalloc
+    """
+
+    func()
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    func()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    for i in range(number):
+        func()
+    held = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return peak, held / (number + 1)
+
+def bench_ops(args):
+    """ client-side cost of each public operation on the in-memory
+    transport: time, peak memory of one op and memory still held per op.
+    --profile and --tracemalloc list each op's hot spots; --save and
+    --compare keep a baseline so a change's effect on the per-charge
+    overhead shows in review.
+    """
+
+    handler = logging.StreamHandler(io.StringIO())
+    saved = api.logger.handlers, api.logger.propagate, api.logger.level
+    api.logger.handlers = [handler]
+    api.logger.propagate = False
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    number = max(args.number // 10, 1)
+    _report('operation', 'ns/op', 'peak B/op', 'held B/op',
+        *(['vs baseline'] if baseline else []))
+    try:
+        for name, func in _operations():
+            # only the logged client logs, at INFO
+            api.logger.setLevel(logging.INFO if name == 'call, logged'
+                else logging.WARNING)
+            handler.stream.seek(0)
+            handler.stream.truncate()
+
+            ns = _time(func, number, args.repeat)
+            peak, held = _memory(func, min(number, 1000))
+            results[name] = {'ns': ns, 'peak': peak, 'held': held}
+            change = []
+            if name in baseline:
+                change = ['%+.1f%%' % ((ns / baseline[name]['ns'] - 1) * 100)]
+            elif baseline:
+                change = ['new']
+            _report(name, '%.0f' % ns, '%.0f' % peak, '%.1f' % held, *change)
+
+            if args.profile:
+                _profile(func, number)
+            if args.tracemalloc:
+                _trace_allocations(func, number)
+    finally:
+        api.logger.handlers, api.logger.propagate = saved[:2]
+        api.logger.setLevel(saved[2])
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+def _profile(func, number, top=12):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    for i in range(number):
+        func()
+    profiler.disable()
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('tottime').print_stats(
+        top)
+    # skip the header down to the table
+    lines = stream.getvalue().splitlines()
+    start = next((i for i, line in enumerate(lines) if 'ncalls' in line), 0)
+    print('\n'.join('    ' + line for line in lines[start:] if line))
+
+def _trace_allocations(func, number, top=8):
+    func()
+    tracemalloc.start(10)
+    before = tracemalloc.take_snapshot()
+    for i in range(number):
+        func()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    for stat in after.filter_traces(ignore).compare_to(
+        before.filter_traces(ignore), 'lineno')[:top]:
+        print('    %s' % stat)
+
+def _offline_client(raw, **kwargs):
+    # answers every POST at once with ``raw``, keeping no request history
+    return api.Salt('bench-key', 'bench-merchant',
+        transport=api.InMemoryTransport(raw, history=0), **kwargs)
+
+def _purchase(client):
+    return client.single_purchase(1999, 'order-2016-000123',
+        credit_card_number=4242424242424242, expiry_date=1812, cvv=123)
+
+def bench_logging(args):
+    """ per-call overhead of request/response logging """
+
+    handler = logging.StreamHandler(io.StringIO())
+    saved = api.logger.handlers, api.logger.propagate, api.logger.level
+    api.logger.handlers = [handler]
+    api.logger.propagate = False
+    try:
+        _report('logging', 'ns/call')
+        for label, level, rate in (
+            ('disabled', logging.WARNING, 1.0),
+            ('enabled', logging.INFO, 1.0),
+            ('enabled, 1% sampled', logging.INFO, 0.01),
+        ):
+            api.logger.setLevel(level)
+            client = _offline_client(RECEIPTS['purchase'], debug=True,
+                log_sample_rate=rate)
+            # drop what was written so far, the buffer would grow unbounded
+            handler.stream.seek(0)
+            handler.stream.truncate()
+            _report(label, '%.0f' % _time(lambda: _purchase(client),
+                args.number // 10, args.repeat))
+    finally:
+        api.logger.handlers, api.logger.propagate = saved[:2]
+        api.logger.setLevel(saved[2])
+
+class _Latencies(api.Instrument):
+    """ Instrument collecting the elapsed time of every call """
+
+    def __init__(self):
+        self.samples = []
+
+    def after_response(self, info):
+        self.samples.append(info.elapsed)
+
+    def on_error(self, info):
+        if info.receipt is None:
+            self.samples.append(info.elapsed)
+
+def _percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+def _purchase_specs(count):
+    for i in range(count):
+        yield ('single_purchase', (1999, 'bench-%d' % i), {
+            'credit_card_number': 4242424242424242, 'expiry_date': 1812})
+
+def bench_coalesce(args):
+    """ a polling storm: many threads verifying the same few transactions,
+    with and without SingleFlight
+    """
+
+    gateway = StubGateway(latency=latency_distribution('lognormal',
+        args.latency)).start()
+    seed = api.Salt('bench-key', 'bench-merchant', url=gateway.url)
+    transactions = [_purchase(seed).transaction_id for _ in range(5)]
+    count = max(args.number // 100, 1)
+
+    try:
+        _report('polling (%d calls)' % count, 'calls/s', 'gateway reqs',
+            'deduplicated')
+        for label, coalesce in (('plain', None),
+            ('SingleFlight', api.SingleFlight())):
+            client = api.Salt('bench-key', 'bench-merchant', url=gateway.url,
+                coalesce=coalesce)
+            client.transport.ensure_pool_size(client.endpoint,
+                args.concurrency)
+            before = gateway.requests
+
+            def poll(i):
+                return client.transaction_verification(
+                    transactions[i % len(transactions)])
+
+            start = time.time()
+            with concurrent.futures.ThreadPoolExecutor(
+                args.concurrency) as pool:
+                list(pool.map(poll, range(count)))
+            elapsed = time.time() - start
+            _report(label, '%.0f' % (count / elapsed),
+                gateway.requests - before,
+                coalesce.deduplicated if coalesce else '-')
+    finally:
+        gateway.stop()
+
+def bench_gateway(args):
+    """ throughput and latency of each client against the stub gateway """
+
+    count = max(args.number // 100, 1)
+    gateway = StubGateway(latency=latency_distribution('lognormal',
+        args.latency)).start()
+
+    def sync(client):
+        for operation, op_args, kwargs in _purchase_specs(count):
+            client.single_purchase(*op_args, **kwargs)
+
+    def batch(client):
+        for result in client.submit_many(_purchase_specs(count),
+            max_in_flight=args.concurrency):
+            pass
+
+    def asynchronous(client):
+        async def run():
+            limit = asyncio.Semaphore(args.concurrency)
+            async def one(op_args, kwargs):
+                async with limit:
+                    await client.single_purchase(*op_args, **kwargs)
+            await asyncio.gather(*[one(op_args, kwargs)
+                for operation, op_args, kwargs in _purchase_specs(count)])
+            await client.close()
+        asyncio.run(run())
+
+    from .aio import AsyncSalt
+
+    try:
+        _report('client (%d calls)' % count, 'calls/s', 'p50 ms', 'p99 ms')
+        for label, factory, run in (
+            ('Salt', api.Salt, sync),
+            ('Salt.submit_many', api.Salt, batch),
+            ('AsyncSalt', lambda *a, **kw: AsyncSalt(*a,
+                pool_size=args.concurrency, **kw), asynchronous),
+        ):
+            latencies = _Latencies()
+            client = factory('bench-key', 'bench-merchant', url=gateway.url,
+                instruments=[latencies])
+            start = time.time()
+            run(client)
+            elapsed = time.time() - start
+            _report(label, '%.0f' % (count / elapsed),
+                '%.1f' % (_percentile(latencies.samples, 0.5) * 1000),
+                '%.1f' % (_percentile(latencies.samples, 0.99) * 1000))
+    finally:
+        gateway.stop()
+
+def bench_ratelimit(args):
+    """ C107 denials against a rate-capped stub, with and without a
+    RateLimiter, and the limiter's own cost per call
+    """
+
+    cap = 100
+    count = max(args.number // 250, 1)
+    gateway = StubGateway(max_rate=cap).start()
+    tmp = tempfile.TemporaryDirectory()
+    shared = api.FileRateLimitBackend(os.path.join(tmp.name, 'buckets'))
+
+    try:
+        _report('limiter (%d calls, cap %d/s)' % (count, cap), 'calls/s',
+            'denied', 'waited s')
+        for label, limiter in (
+            ('none', None),
+            ('rate=%d' % cap, api.RateLimiter(cap)),
+            ('rate=%d, adapting' % (cap * 2), api.RateLimiter(cap * 2)),
+            ('rate=%d, file backend' % cap, api.RateLimiter(cap,
+                backend=shared)),
+        ):
+            client = api.Salt('bench-key', 'bench-merchant-%s' % label,
+                url=gateway.url, rate_limiter=limiter)
+            denied = gateway.denied
+            start = time.time()
+            for result in client.submit_many(_purchase_specs(count),
+                max_in_flight=args.concurrency):
+                pass
+            elapsed = time.time() - start
+            _report(label, '%.0f' % (count / elapsed),
+                gateway.denied - denied,
+                '%.1f' % limiter.waited if limiter else '-')
+
+        _report('acquire', 'ns/op')
+        for label, backend in (('local', None), ('file', shared)):
+            limiter = api.RateLimiter(1e9, backend=backend)
+            _report(label, '%.0f' % _time(lambda: limiter.acquire(
+                'bench-merchant', 'singlePurchase'), args.number // 100 or 1,
+                args.repeat))
+    finally:
+        gateway.stop()
+        tmp.cleanup()
+
+def bench_transport(args):
+    """ first-call latency on a cold and a pre-warmed transport, and the
+    in-memory transport's cost per call
+    """
+
+    gateway = StubGateway().start()
+    try:
+        _report('transport', 'first call ms', 'later calls ms')
+        for label, warm in (('cold', 0), ('warmed', args.concurrency)):
+            client = api.Salt('bench-key', 'bench-merchant', url=gateway.url)
+            if warm:
+                client.warm(warm)
+            start = time.time()
+            _purchase(client)
+            first = time.time() - start
+            start = time.time()
+            for _ in range(20):
+                _purchase(client)
+            later = (time.time() - start) / 20
+            _report(label, '%.2f' % (first * 1000), '%.2f' % (later * 1000))
+            client.transport.close()
+    finally:
+        gateway.stop()
+
+    client = api.Salt('bench-key', 'bench-merchant',
+        transport=api.InMemoryTransport(StubGateway().respond))
+    _report('in-memory stub', '%.0f ns/call' % _time(lambda: _purchase(client),
+        args.number // 10 or 1, args.repeat))
+
+class _RecordingGateway(StubGateway):
+    """ StubGateway remembering the CVV each charge (by order) and each
+    verification (by street) arrived with
+    """
+
+    def __init__(self, *args, **kwargs):
+        StubGateway.__init__(self, *args, **kwargs)
+        self.cvvs = {}
+
+    def answer(self, params):
+        request_code = params.get('requestCode')
+        if request_code == 'singlePurchase':
+            self.cvvs[params['orderId']] = params.get('cvv')
+        elif request_code == 'verifyCreditCard':
+            self.cvvs[params['street']] = params.get('cvv')
+        return StubGateway.answer(self, params)
+
+def bench_stress(args):
+    """ one client shared by many threads charging and verifying cards;
+    checks nothing leaks between calls
+    """
+
+    count = max(args.number // 10, 1)
+    gateway = _RecordingGateway().start()
+    client = api.Salt('bench-key', 'bench-merchant', url=gateway.url,
+        last_request_scope='thread')
+    client.transport.ensure_pool_size(client.endpoint, args.concurrency)
+
+    def one(i):
+        name = 'stress-%d' % i
+        cvv = '%03d' % (i % 1000)
+        problems = []
+        if i % 2:
+            client.credit_card_verification(4242424242424242, 1812, '90210',
+                name, cvv=cvv)
+            sent = client.last_request['request_body'].get('street')
+        else:
+            receipt = client.single_purchase(i + 1, name,
+                credit_card_number=4242424242424242, expiry_date=1812,
+                cvv=cvv)
+            if receipt['ORDER_ID'] != name:
+                problems.append('receipt for %s' % receipt['ORDER_ID'])
+            sent = client.last_request['request_body'].get('orderId')
+        if sent != name:
+            problems.append('last_request of another call')
+        return problems
+
+    try:
+        start = time.time()
+        problems = []
+        with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+            for found in pool.map(one, range(count)):
+                problems.extend(found)
+        elapsed = time.time() - start
+
+        for i in range(count):
+            if gateway.cvvs.get('stress-%d' % i) != '%03d' % (i % 1000):
+                problems.append('wrong cvv for stress-%d' % i)
+    finally:
+        gateway.stop()
+
+    _report('stress', 'calls', 'threads', 'calls/s', 'problems')
+    _report('shared Salt', count, args.concurrency, '%.0f' % (count / elapsed),
+        len(problems))
+    for problem in sorted(set(problems))[:10]:
+        print('  %s' % problem)
+    if problems:
+        sys.exit('stress: %d problems' % len(problems))
+
+def bench_billing(args):
+    """ BillingRun throughput and peak memory as the run grows """
+
+    client = _offline_client(RECEIPTS['purchase'])
+    _report('orders', 'orders/s', 'peak KiB')
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in (args.number // 10, args.number):
+            results = os.path.join(tmp, 'results-%d.jsonl' % count)
+            orders = ('order-%d' % i for i in range(count))
+            run = BillingRun(client, orders, results,
+                checkpoint=results + '.checkpoint',
+                max_in_flight=args.concurrency)
+            tracemalloc.start()
+            summary = run.run()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            assert summary['succeeded'] == count
+            _report(count, '%.0f' % (count / summary['elapsed']),
+                '%.0f' % (peak / 1024.0))
+
+def bench_fraud(args):
+    """ draining a backlog of fraud updates: one by one, then through
+    FraudUpdateQueue, against the stub gateway
+    """
+
+    count = max(args.number // 100, 1)
+    gateway = StubGateway(latency=latency_distribution('lognormal',
+        args.latency)).start()
+    try:
+        _report('fraud updates (%d)' % count, 'updates/s', 'submit us')
+        client = api.Salt('bench-key', 'bench-merchant', url=gateway.url)
+        start = time.time()
+        for i in range(count):
+            client.fraud(i + 1, 1, 1)
+        _report('Salt.fraud', '%.0f' % (count / (time.time() - start)), '-')
+
+        client.transport.ensure_pool_size(client.endpoint, args.concurrency)
+        updates = FraudUpdateQueue(client, workers=args.concurrency,
+            maxsize=count)
+        start = time.time()
+        for i in range(count):
+            updates.submit(i + 1, 1, 1)
+        submitted = time.time() - start
+        updates.close()
+        elapsed = time.time() - start
+        assert updates.sent == count
+        _report('FraudUpdateQueue', '%.0f' % (count / elapsed),
+            '%.1f' % (submitted / count * 1e6))
+    finally:
+        gateway.stop()
+
+def _mixed_reply(params):
+    # purchases and storage queries, one purchase in ten declined
+    if params.get('requestCode') == 'secureStorage':
+        return RECEIPTS['storage']
+    if params.get('orderId', '').endswith('7'):
+        return RECEIPTS['declined']
+    return RECEIPTS['purchase']
+
+def bench_replay(args):
+    """ recording overhead, then client-side cost per call replaying the
+    recording flat out against its stand-in
+    """
+
+    count = max(args.number // 10, 1)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'traffic.jsonl.gz')
+        _report('%d calls' % count, 'us/call', 'calls/s', 'mismatches')
+        for label, transport in (
+            ('in-memory', api.InMemoryTransport(_mixed_reply)),
+            ('recording', RecordingTransport(path,
+                api.InMemoryTransport(_mixed_reply)))):
+            client = api.Salt('bench-key', 'bench-merchant',
+                transport=transport)
+            start = time.perf_counter()
+            for i in range(count):
+                try:
+                    if i % 4 == 3:
+                        client.secure_storage.query('cust-%d' % i)
+                    else:
+                        client.single_purchase(1999, 'order-%d' % i,
+                            credit_card_number=4242424242424242,
+                            expiry_date=1812, cvv=123)
+                except api.Declined:
+                    pass
+            elapsed = time.perf_counter() - start
+            transport.close()
+            _report(label, '%.1f' % (elapsed / count * 1e6),
+                '%.0f' % (count / elapsed), '-')
+
+        for label, max_in_flight in (('replay', 1),
+            ('replay x%d' % args.concurrency, args.concurrency)):
+            summary = Replay(path, speed=0, max_in_flight=max_in_flight).run()
+            _report(label, '%.1f' % summary['mean_us'],
+                '%.0f' % summary['rate'], summary['mismatches'])
+        _report('log size', '%.0f B/call' % (os.path.getsize(path) / count),
+            '', '')
+
+# run in a fresh interpreter by bench_startup; prints milliseconds
+_STARTUP = '''
+import time
+start = time.perf_counter()
+%(setup)s
+from %(package)s import api
+imported = time.perf_counter()
+client = api.Salt('bench-key', 'bench-merchant', url=%(url)r%(options)s)
+client.single_purchase(1999, 'order-1', storage_token_id='token-1')
+first = time.perf_counter()
+client.single_purchase(1999, 'order-2', storage_token_id='token-1')
+second = time.perf_counter()
+print('%%f %%f %%f' %% ((imported - start) * 1000, (first - imported) * 1000,
+    (second - first) * 1000))
+'''
+
+def bench_startup(args):
+    """ cold start of a short-lived process: importing the client, then
+    its first and second call, each in a fresh interpreter
+    """
+
+    gateway = StubGateway().start()
+    package = api.__name__.rpartition('.')[0]
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = (
+        ('stub gateway', '', ''),
+        ('stub, requests preloaded', 'import requests', ''),
+        ('in-memory', '', ', transport=api.InMemoryTransport(%r)' %
+            RECEIPTS['purchase']),
+    )
+    try:
+        _report('startup (best of %d)' % args.repeat, 'import ms',
+            'first call ms', 'second ms')
+        for label, setup, options in runs:
+            code = _STARTUP % {'setup': setup, 'package': package,
+                'url': gateway.url, 'options': options}
+            best = None
+            for i in range(args.repeat):
+                out = subprocess.check_output([sys.executable, '-c', code],
+                    cwd=cwd)
+                timings = [float(value) for value in out.split()]
+                if best is None or sum(timings) < sum(best):
+                    best = timings
+            _report(label, *('%.1f' % value for value in best))
+    finally:
+        gateway.stop()
+
+BENCHMARKS = {
+    'billing': bench_billing,
+    'build': bench_build,
+    'coalesce': bench_coalesce,
+    'fraud': bench_fraud,
+    'gateway': bench_gateway,
+    'logging': bench_logging,
+    'memory': bench_memory,
+    'ops': bench_ops,
+    'outbox': bench_outbox,
+    'parse': bench_parse,
+    'ratelimit': bench_ratelimit,
+    'replay': bench_replay,
+    'startup': bench_startup,
+    'stress': bench_stress,
+    'transport': bench_transport,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('-n', '--number', type=int, default=100000,
+        help='calls per timing run')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+        help='timing runs, the best one is reported')
+    parser.add_argument('-c', '--concurrency', type=int, default=20,
+        help='calls in flight for the concurrent clients and threads')
+    parser.add_argument('-l', '--latency', type=float, default=0.02,
+        help='median stub gateway latency in seconds')
+    parser.add_argument('--profile', action='store_true',
+        help='ops: print where each operation spends its time (cProfile)')
+    parser.add_argument('--tracemalloc', action='store_true',
+        help='ops: print the lines still holding memory allocated by each '
+        'operation')
+    parser.add_argument('--save', metavar='PATH',
+        help='ops: write the results as JSON, for --compare later')
+    parser.add_argument('--compare', metavar='PATH',
+        help='ops: show the change in ns/op against a saved baseline')
+    args = parser.parse_args(argv)
+    BENCHMARKS[args.benchmark](args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+""" Streaming billing runs: RecurringPurchase.execute over millions of orders
+
+    run = BillingRun(salt, orders, 'renewals.jsonl',
+        checkpoint='renewals.checkpoint', max_in_flight=20, rate=50)
+    summary = run.run()
+
+``orders`` is any iterable of order IDs, or of dicts of
+RecurringPurchase.execute keyword arguments (order_id, cvv, ...), usually a
+generator over the customer table. It is read only as fast as calls go out,
+and each outcome is appended to the results file as a JSON line the moment
+it arrives, so memory use does not grow with the length of the run.
+
+Progress is journalled to the checkpoint file. After a crash, run the same
+BillingRun again over the same orders in the same order and it carries on
+where it stopped. An order that had been sent but not answered when the
+process died is not sent again, since it may well have been charged; it gets
+a result with status "unknown" for reconciliation instead, unless
+retry_unknown is set.
+"""
+
+import functools
+import itertools
+import json
+import os
+import time
+
+from .api import Error, TokenBucket, _error_code
+
+
+class Checkpoint(object):
+    """ Journal of a billing run's progress.
+
+    Every order up to ``position`` is finished. Past it, ``sent`` holds the
+    orders handed to the gateway and ``done`` those whose result is written;
+    both stay about as small as the number of calls in flight.
+
+    The file is a list of lines, appended as the run goes and compacted
+    every so often:
+
+        w <position>
+        s <index>
+        d <index>
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.position = 0
+        self.sent = set()
+        self.done = set()
+        self._file = None
+        if path is not None and os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                kind, _, index = line.partition(' ')
+                try:
+                    index = int(index)
+                except ValueError:
+                    # torn last line from a crash mid-write
+                    continue
+                if kind == 'w':
+                    self.position = index
+                elif kind == 's':
+                    self.sent.add(index)
+                elif kind == 'd':
+                    self.done.add(index)
+        self.sent -= self.done
+        self._advance()
+
+    def _advance(self):
+        done = self.done
+        while self.position in done:
+            done.remove(self.position)
+            self.position += 1
+
+    def _write(self, line):
+        if self.path is None:
+            return
+        if self._file is None:
+            self._file = open(self.path, 'a', buffering=1)
+        self._file.write(line)
+
+    def mark_sent(self, index):
+        self.sent.add(index)
+        self._write('s %d\n' % index)
+
+    def mark_done(self, index):
+        self.sent.discard(index)
+        self.done.add(index)
+        self._write('d %d\n' % index)
+        self._advance()
+
+    def compact(self):
+        """ Rewrite the journal as just the current state """
+
+        if self.path is None:
+            return
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        lines = ['w %d\n' % self.position]
+        lines.extend('s %d\n' % index for index in sorted(self.sent))
+        lines.extend('d %d\n' % index for index in sorted(self.done))
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def close(self):
+        self.compact()
+
+
+def run_journalled(client, checkpoint, items, prepare, finish, skip,
+    max_in_flight=10, checkpoint_every=10000, after=None):
+    """ Make a call per item through client.submit_many, journalling
+    progress to a Checkpoint so a stopped run carries on where it left off.
+
+    Items an earlier run finished go to skip(index). For the others
+    prepare(index, item, unanswered) returns the (spec, tag) to send, or
+    None for an item it settled without a call; ``unanswered`` tells if an
+    earlier run sent it and stopped before the reply. Each BatchResult goes
+    to finish(index, tag, result), then after(journal, compacted) if given.
+
+    Args:
+        client (Salt): client to call through
+        checkpoint (str): path of the journal, None for a run that can't be
+            resumed
+        items (iterable): read only as fast as calls go out
+
+    Optional Args:
+        max_in_flight (int): concurrent gateway calls, defaults to 10
+        checkpoint_every (int): results between journal compactions,
+            defaults to 10000
+    """
+
+    journal = Checkpoint(checkpoint)
+    # submit_many numbers the specs it is given; this maps those numbers
+    # back to positions in items for the calls not answered yet
+    in_flight = {}
+
+    def specs():
+        # runs on the submit_many thread, between its gateway calls, so the
+        # journal and the callers' counters need no locking
+        resumed = journal.position
+        previously_done = journal.done.copy()
+        unanswered = journal.sent.copy()
+        numbers = itertools.count()
+
+        for index, item in enumerate(items):
+            if index < resumed or index in previously_done:
+                skip(index)
+                continue
+
+            prepared = prepare(index, item, index in unanswered)
+            if prepared is None:
+                journal.mark_done(index)
+                continue
+
+            spec, tag = prepared
+            journal.mark_sent(index)
+            in_flight[next(numbers)] = (index, tag)
+            yield spec
+
+    since_compact = 0
+    try:
+        for result in client.submit_many(specs(), max_in_flight):
+            index, tag = in_flight.pop(result.index)
+            finish(index, tag, result)
+            journal.mark_done(index)
+
+            since_compact += 1
+            compacted = since_compact >= checkpoint_every
+            if compacted:
+                since_compact = 0
+                journal.compact()
+            if after is not None:
+                after(journal, compacted)
+    finally:
+        journal.close()
+
+
+class BillingRun(object):
+    """ Execute recurring purchases for a stream of orders.
+
+    Args:
+        client (Salt): client to bill through
+        orders (iterable): order IDs, or dicts of keyword arguments for
+            RecurringPurchase.execute including order_id
+        results (str): path of the JSON lines file results are appended to
+
+    Optional Args:
+        checkpoint (str): path of the progress journal; without one a crashed
+            run can not be resumed
+        max_in_flight (int): concurrent gateway calls, defaults to 10
+        rate (float): most calls to start per second, unlimited by default
+        checkpoint_every (int): results between journal compactions,
+            defaults to 10000
+        retry_unknown (bool): on resume, send again the orders that were in
+            flight when the last run stopped instead of reporting them as
+            unknown
+    """
+
+    def __init__(self, client, orders, results, checkpoint=None,
+        max_in_flight=10, rate=None, checkpoint_every=10000,
+        retry_unknown=False):
+        if max_in_flight < 1: raise Error('max_in_flight must be at least 1')
+
+        self.client = client
+        self.orders = orders
+        self.results = results
+        self.checkpoint = checkpoint
+        self.max_in_flight = max_in_flight
+        self.bucket = TokenBucket(rate) if rate else None
+        self.checkpoint_every = checkpoint_every
+        self.retry_unknown = retry_unknown
+
+        self.sent = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.unknown = 0
+        self.skipped = 0
+        self.elapsed = None
+
+    def _skip(self, index):
+        self.skipped += 1
+
+    def _prepare(self, out, index, order, unanswered):
+        if isinstance(order, dict):
+            kwargs = dict(order)
+        else:
+            kwargs = {'order_id': order}
+        kwargs.setdefault('cvv', None)
+
+        if unanswered and not self.retry_unknown:
+            self._write(out, index, kwargs['order_id'], 'unknown')
+            self.unknown += 1
+            return None
+
+        if self.bucket is not None:
+            self.bucket.acquire()
+        self.sent += 1
+        return ('recuring_purchase.execute', kwargs), kwargs['order_id']
+
+    def _finish(self, out, index, order_id, result):
+        if result.ok:
+            self.succeeded += 1
+            self._write(out, index, order_id, 'ok', result.receipt)
+        else:
+            self.failed += 1
+            self._write(out, index, order_id, 'error', error=result.error)
+
+    def _after(self, journal, compacted):
+        if compacted:
+            self.client.log('Billing run at order %d: %s', journal.position,
+                self.summary())
+
+    def _write(self, out, index, order_id, status, receipt=None, error=None):
+        result = {'index': index, 'order_id': order_id, 'status': status}
+        if receipt is not None:
+            result['transaction_id'] = receipt.get('TRANSACTION_ID')
+            result['approval_code'] = receipt.get('APPROVAL_CODE')
+            result['amount'] = receipt.get('APPROVED_AMOUNT',
+                receipt.get('AMOUNT'))
+        if error is not None:
+            result['error'] = _error_code(error)
+        out.write(json.dumps(result, separators=(',', ':')) + '\n')
+
+    def run(self):
+        """ Bill every order, returning the summary() at the end """
+
+        start = time.time()
+        out = open(self.results, 'a', buffering=1)
+        try:
+            run_journalled(self.client, self.checkpoint, self.orders,
+                functools.partial(self._prepare, out),
+                functools.partial(self._finish, out), self._skip,
+                self.max_in_flight, self.checkpoint_every, self._after)
+        finally:
+            out.close()
+            self.elapsed = time.time() - start
+
+        return self.summary()
+
+    def summary(self):
+        return {
+            'sent': self.sent,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'unknown': self.unknown,
+            'skipped': self.skipped,
+            'elapsed': self.elapsed,
+        }
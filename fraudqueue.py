@@ -0,0 +1,245 @@
+""" Background fraud updates: Salt.fraud without waiting on the gateway
+
+    updates = FraudUpdateQueue(salt, workers=8)
+    updates.submit(transaction_id, fraud_session_id, auth)
+    ...
+    updates.close()  # sends whatever is still queued
+
+submit() checks the arguments, queues the update and returns straight
+away; a pool of worker threads sends queued updates through the client.
+The queue holds at most ``maxsize`` updates: past that, submit() raises
+Overloaded, or waits for room when asked to block, so a gateway outage
+can't grow it without bound. Updates failing with a retryable error
+(classify()) are sent again after the retry policy's backoff; the ones
+that still fail are passed to ``on_error`` and logged through the client.
+
+Anything queued when the interpreter exits is flushed first.
+"""
+
+import atexit
+import collections
+import threading
+import time
+
+from .api import Error, Overloaded, RetryPolicy, FRAUD_UPDATE, _error_code, \
+    logger
+
+
+class FraudUpdateQueue(object):
+    """ Bounded queue of fraud updates drained by a pool of workers.
+
+    Args:
+        client (Salt): client to send the updates through
+
+    Optional Args:
+        workers (int): updates sent at once, defaults to 4
+        maxsize (int): updates waiting to be sent before submit() pushes
+            back, defaults to 100000
+        retry (RetryPolicy): attempts and backoff for retryable failures,
+            defaults to 5 attempts; its retry_on and deadline are not used
+        on_error (callable): called with (params, error) for each update
+            given up on
+    """
+
+    def __init__(self, client, workers=4, maxsize=100000, retry=None,
+        on_error=None):
+        if workers < 1: raise Error('workers must be at least 1')
+
+        self.client = client
+        self.workers = workers
+        self.maxsize = maxsize
+        self.retry = retry if retry is not None else RetryPolicy(attempts=5)
+        self.on_error = on_error
+
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._threads = []
+        self._closed = False
+        self.in_flight = 0
+        self.submitted = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        # completions per whole second, for throughput()
+        self._completed = collections.deque()
+        self._start = None
+
+    @property
+    def depth(self):
+        """ Updates waiting for a worker """
+        return len(self._queue)
+
+    def submit(self, transaction_id, fraud_session_id, auth, block=False,
+        timeout=None, **kwargs):
+        """ Queue a fraud update, taking Salt.fraud's arguments.
+
+        Optional Args:
+            block (bool): wait for room while the queue is full instead of
+                raising Overloaded
+            timeout (float): most seconds to wait when blocking
+        """
+
+        kwargs['transaction_id'] = transaction_id
+        kwargs['fraud_session_id'] = fraud_session_id
+        kwargs['auth'] = auth
+        params = FRAUD_UPDATE.build(kwargs, self.client.validate)
+
+        with self._cond:
+            if self._closed:
+                raise Error('Fraud update queue is closed')
+            if len(self._queue) >= self.maxsize:
+                if not block:
+                    raise Overloaded('%d fraud updates queued, limit %d' % (
+                        len(self._queue), self.maxsize))
+                give_up = None if timeout is None else time.time() + timeout
+                while len(self._queue) >= self.maxsize and not self._closed:
+                    remaining = None if give_up is None else \
+                        give_up - time.time()
+                    if remaining is not None and remaining <= 0:
+                        raise Overloaded('%d fraud updates queued, limit %d'
+                            % (len(self._queue), self.maxsize))
+                    self._cond.wait(remaining)
+                if self._closed:
+                    raise Error('Fraud update queue is closed')
+
+            if not self._threads:
+                self._start_workers()
+            self._queue.append(params)
+            self.submitted += 1
+            self._cond.notify_all()
+
+    def _start_workers(self):
+        self._start = time.time()
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                name='salt-fraud-%d' % number)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        atexit.register(self.close)
+
+    def _work(self):
+        cond = self._cond
+        while True:
+            with cond:
+                while not self._queue and not self._closed:
+                    cond.wait()
+                if not self._queue:
+                    return
+                params = self._queue.popleft()
+                self.in_flight += 1
+                # room for a blocked submit()
+                cond.notify_all()
+
+            # a worker that dies leaves the queue undrained and close()
+            # waiting forever, at interpreter exit too: nothing may escape
+            error = params
+            try:
+                error = self._send(params)
+            except Exception as e:
+                error = e
+            finally:
+                self._done(error)
+
+            if error is not None:
+                try:
+                    self.client.log('Fraud update for transaction %s '
+                        'failed: %s', params.get('transactionId'),
+                        _error_code(error))
+                    if self.on_error is not None:
+                        self.on_error(params, error)
+                except Exception:
+                    logger.exception('Fraud update on_error callback %r '
+                        'failed', self.on_error)
+
+    def _done(self, error):
+        with self._cond:
+            self.in_flight -= 1
+            if error is None:
+                self.sent += 1
+            else:
+                self.failed += 1
+            second = int(time.time())
+            completed = self._completed
+            if completed and completed[-1][0] == second:
+                completed[-1][1] += 1
+            else:
+                completed.append([second, 1])
+                while completed[0][0] < second - 60:
+                    completed.popleft()
+            self._cond.notify_all()
+
+    def _send(self, params):
+        """ Send one update, retrying as allowed; the error given up on, or
+        None once sent
+        """
+
+        retry = self.retry
+        attempt = 1
+        while True:
+            try:
+                self.client.call(params)
+                return None
+            except Error as e:
+                if not e.retryable or attempt >= retry.attempts:
+                    return e
+            except Exception as e:
+                # not one of ours (an unmapped transport exception, a bug in
+                # a custom transport): nothing says a retry would help
+                return e
+            retry.sleep(retry.delay(attempt))
+            attempt += 1
+            with self._cond:
+                self.retried += 1
+
+    def flush(self, timeout=None):
+        """ Wait until every update submitted so far has been sent or given
+        up on. Returns False if ``timeout`` seconds ran out first.
+        """
+
+        give_up = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._queue or self.in_flight:
+                remaining = None if give_up is None else give_up - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """ Stop taking updates, send those queued and stop the workers """
+
+        with self._cond:
+            if self._closed:
+                return
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        atexit.unregister(self.close)
+
+    def throughput(self, window=10.0):
+        """ Updates completed per second over the last ``window`` seconds
+        (at most 60)
+        """
+
+        now = time.time()
+        since = int(now - window)
+        with self._cond:
+            count = sum(n for second, n in self._completed if second > since)
+        if self._start is not None:
+            window = min(window, now - self._start) or window
+        return count / window
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'in_flight': self.in_flight,
+            'submitted': self.submitted,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'throughput': self.throughput(),
+        }
@@ -0,0 +1,172 @@
+""" In-memory metrics for gateway calls, with a Prometheus text exporter
+
+    collector = MetricsCollector()
+    salt = Salt(apikey, merchant_id, instruments=[collector])
+    ...
+    body = prometheus_text(collector)
+"""
+
+import bisect
+import collections
+import threading
+
+from .api import Instrument
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram(object):
+    """ Fixed-bucket latency histogram """
+
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        # one slot per bucket plus the overflow (+Inf) slot
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q-th quantile """
+
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float('inf'),),
+            self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+class MetricsCollector(Instrument):
+    """ Instrument keeping call metrics in memory.
+
+    Tracked per (requestCode, operationCode): a latency histogram, request
+    count, bytes sent and received; per (requestCode, error code): errors,
+    keyed by their ERROR_MAP code; overall: new and reused connections.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = collections.defaultdict(Histogram)
+        self.requests = collections.Counter()
+        self.errors = collections.Counter()
+        self.bytes_sent = collections.Counter()
+        self.bytes_received = collections.Counter()
+        self.connections_new = 0
+        self.connections_reused = 0
+
+    def after_response(self, info):
+        key = (info.request_code, info.operation_code)
+        with self._lock:
+            self.latency[key].observe(info.elapsed)
+            self.requests[key] += 1
+            self.bytes_sent[key] += info.bytes_sent or 0
+            self.bytes_received[key] += info.bytes_received or 0
+            if info.connection_reused is True:
+                self.connections_reused += 1
+            elif info.connection_reused is False:
+                self.connections_new += 1
+
+    def on_error(self, info):
+        with self._lock:
+            self.errors[(info.request_code, info.error_code)] += 1
+            if info.receipt is None:
+                # no response at all; count the attempt and its wait too
+                key = (info.request_code, info.operation_code)
+                self.latency[key].observe(info.elapsed)
+                self.requests[key] += 1
+
+    @property
+    def connection_reuse_rate(self):
+        total = self.connections_new + self.connections_reused
+        if not total:
+            return None
+        return self.connections_reused / float(total)
+
+    def snapshot(self):
+        """ A consistent copy of every metric, for exporting """
+
+        with self._lock:
+            latency = {}
+            for key, histogram in self.latency.items():
+                copy = Histogram()
+                copy.counts = list(histogram.counts)
+                copy.total = histogram.total
+                copy.count = histogram.count
+                latency[key] = copy
+            return {
+                'latency': latency,
+                'requests': dict(self.requests),
+                'errors': dict(self.errors),
+                'bytes_sent': dict(self.bytes_sent),
+                'bytes_received': dict(self.bytes_received),
+                'connections_new': self.connections_new,
+                'connections_reused': self.connections_reused,
+            }
+
+def _labels(**labels):
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\',
+        '\\\\').replace('"', '\\"')) for name, value in sorted(labels.items())
+        if value is not None)
+
+def prometheus_text(collector, prefix='salt_api'):
+    """ Render a MetricsCollector in the Prometheus text exposition format """
+
+    data = collector.snapshot()
+    lines = []
+
+    name = '%s_request_duration_seconds' % prefix
+    lines.append('# HELP %s Gateway request latency.' % name)
+    lines.append('# TYPE %s histogram' % name)
+    for (request_code, operation_code), histogram in sorted(
+        data['latency'].items(), key=lambda item: str(item[0])):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',),
+            histogram.counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (name, _labels(
+                request_code=request_code, operation_code=operation_code,
+                le=bound), cumulative))
+        labels = _labels(request_code=request_code,
+            operation_code=operation_code)
+        lines.append('%s_sum%s %.6f' % (name, labels, histogram.total))
+        lines.append('%s_count%s %d' % (name, labels, histogram.count))
+
+    for metric, help_text in (
+        ('bytes_sent', 'Request body bytes sent.'),
+        ('bytes_received', 'Response body bytes received.'),
+    ):
+        name = '%s_%s_total' % (prefix, metric)
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s counter' % name)
+        for (request_code, operation_code), value in sorted(
+            data[metric].items(), key=lambda item: str(item[0])):
+            lines.append('%s%s %d' % (name, _labels(request_code=request_code,
+                operation_code=operation_code), value))
+
+    name = '%s_errors_total' % prefix
+    lines.append('# HELP %s Failed calls by error code.' % name)
+    lines.append('# TYPE %s counter' % name)
+    for (request_code, code), value in sorted(data['errors'].items(),
+        key=lambda item: str(item[0])):
+        lines.append('%s%s %d' % (name, _labels(request_code=request_code,
+            code=code), value))
+
+    name = '%s_connections_total' % prefix
+    lines.append('# HELP %s Requests by whether their connection was '
+        'reused.' % name)
+    lines.append('# TYPE %s counter' % name)
+    lines.append('%s%s %d' % (name, _labels(reused='false'),
+        data['connections_new']))
+    lines.append('%s%s %d' % (name, _labels(reused='true'),
+        data['connections_reused']))
+
+    return '\n'.join(lines) + '\n'
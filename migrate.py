@@ -0,0 +1,198 @@
+""" Bulk tokenization: load a file of cards into SecureStorage
+
+    migration = StorageMigration(salt, 'cards.csv', 'cards.ledger.jsonl',
+        checkpoint='cards.checkpoint', max_in_flight=20)
+    summary = migration.run()
+
+The input is CSV with a header row, or JSON lines, one card per record,
+with fields named as SecureStorage.create's arguments (storage_token_id,
+credit_card_number, expiry_date, profile_first_name, ...); pass ``fields``
+to map other column names onto them. Records are read one at a time and
+at most ``max_in_flight`` are being stored at once, so memory stays the
+same whatever the size of the file.
+
+A token that already exists is updated instead. Each outcome is appended
+to the ledger as a JSON line with the record's line number, token and
+status (created, updated or failed, with the error code), never the card
+itself. With a checkpoint, a run that stopped part way resumes after the
+last record stored; records that were in flight are stored again, which
+the fallback to update makes safe.
+"""
+
+import csv
+import functools
+import json
+import time
+
+from .api import Error, StorageTokenIdAlreadyInUse, _error_code
+from .billing import run_journalled
+
+
+def _read_csv(path):
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            yield row
+
+def _read_jsonl(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+READERS = {
+    'csv': _read_csv,
+    'jsonl': _read_jsonl,
+}
+
+
+class StorageMigration(object):
+    """ Store every card of an input file in SecureStorage.
+
+    Args:
+        client (Salt): client to store through
+        source (str): path of the CSV or JSON lines input
+        ledger (str): path of the JSON lines file outcomes are appended to
+
+    Optional Args:
+        checkpoint (str): path of the progress journal; without one a
+            stopped run starts again from the first record
+        format (str): 'csv' or 'jsonl', by default from the file extension
+        fields (dict): input column name to SecureStorage.create argument
+        max_in_flight (int): concurrent gateway calls, defaults to 10
+        checkpoint_every (int): records between journal compactions,
+            defaults to 10000
+        report_every (float): seconds between progress reports, defaults
+            to 10
+        progress (callable): called with summary() at each report, besides
+            logging it through the client
+    """
+
+    def __init__(self, client, source, ledger, checkpoint=None, format=None,
+        fields=None, max_in_flight=10, checkpoint_every=10000,
+        report_every=10.0, progress=None):
+        if max_in_flight < 1: raise Error('max_in_flight must be at least 1')
+        if format is None:
+            format = source.rsplit('.', 1)[-1].lower()
+        if format not in READERS:
+            raise Error('Unknown input format %r' % format)
+
+        self.client = client
+        self.source = source
+        self.ledger = ledger
+        self.checkpoint = checkpoint
+        self.format = format
+        self.fields = fields or {}
+        self.max_in_flight = max_in_flight
+        self.checkpoint_every = checkpoint_every
+        self.report_every = report_every
+        self.progress = progress
+
+        self.created = 0
+        self.updated = 0
+        self.failed = 0
+        self.skipped = 0
+        self.elapsed = None
+        self._start = None
+        self._next_report = None
+
+    def store(self, storage_token_id, credit_card_number, expiry_date,
+        **kwargs):
+        """ Create the profile, or update it if the token is taken.
+        Returns ('created' or 'updated', receipt).
+        """
+
+        storage = self.client.secure_storage
+        try:
+            return 'created', storage.create(storage_token_id,
+                credit_card_number, expiry_date, **kwargs)
+        except StorageTokenIdAlreadyInUse:
+            return 'updated', storage.update(storage_token_id,
+                credit_card_number, expiry_date, **kwargs)
+
+    def _record(self, row):
+        fields = self.fields
+        kwargs = {}
+        for name, value in row.items():
+            if value is None or value == '':
+                continue
+            kwargs[fields.get(name, name)] = value
+        return kwargs
+
+    def _skip(self, index):
+        self.skipped += 1
+
+    def _prepare(self, out, index, row, unanswered):
+        # records in flight when a run stopped are simply stored again
+        kwargs = self._record(row)
+        token = kwargs.get('storage_token_id')
+        if token is None or 'credit_card_number' not in kwargs or \
+            'expiry_date' not in kwargs:
+            self.failed += 1
+            self._write(out, index, token, 'failed', 'missing fields')
+            return None
+        return (self.store, kwargs), token
+
+    def _finish(self, out, index, token, result):
+        if result.ok:
+            status, receipt = result.receipt
+            if status == 'created':
+                self.created += 1
+            else:
+                self.updated += 1
+            self._write(out, index, token, status)
+        else:
+            self.failed += 1
+            self._write(out, index, token, 'failed',
+                _error_code(result.error))
+
+    def _after(self, journal, compacted):
+        if self.report_every and time.time() >= self._next_report:
+            self._next_report += self.report_every
+            self._report()
+
+    def _write(self, out, index, token, status, error=None):
+        entry = {'line': index, 'storage_token_id': token, 'status': status}
+        if error is not None:
+            entry['error'] = error
+        out.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+    def run(self):
+        """ Store every record, returning the summary() at the end """
+
+        self._start = time.time()
+        self._next_report = self._start + self.report_every
+
+        out = open(self.ledger, 'a', buffering=1)
+        try:
+            run_journalled(self.client, self.checkpoint,
+                READERS[self.format](self.source),
+                functools.partial(self._prepare, out),
+                functools.partial(self._finish, out), self._skip,
+                self.max_in_flight, self.checkpoint_every, self._after)
+        finally:
+            out.close()
+            self.elapsed = time.time() - self._start
+
+        self._report()
+        return self.summary()
+
+    def _report(self):
+        summary = self.summary()
+        self.client.log('Storage migration: %(created)d created, '
+            '%(updated)d updated, %(failed)d failed, %(rate).1f/s', summary)
+        if self.progress is not None:
+            self.progress(summary)
+
+    def summary(self):
+        elapsed = self.elapsed
+        if elapsed is None and self._start is not None:
+            elapsed = time.time() - self._start
+        done = self.created + self.updated + self.failed
+        return {
+            'created': self.created,
+            'updated': self.updated,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'elapsed': elapsed,
+            'rate': done / elapsed if elapsed else 0.0,
+        }
@@ -0,0 +1,270 @@
+""" Write-ahead outbox: never lose track of a charge across a crash
+
+    outbox = Outbox('/var/lib/shop/salt-outbox.jsonl')
+    salt = Salt(apikey, merchant_id, outbox=outbox)
+    for entry in outbox.recover(salt):
+        ...  # settle what the last process left open
+
+Before a purchase or refund goes out, its intent (merchant, request code,
+order ID, amount; never card data) is written to an append-only file, and
+its outcome is added once the gateway has answered. Intents are
+group-committed: callers arriving together share one write and fsync, so
+the log costs about one disk sync per burst rather than per call.
+
+Entries whose outcome never made it to the log, because the process died
+or the gateway could not be reached, are looked up with
+transaction_verification by recover(), normally run at startup.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+
+from .api import Error, TimedOut, NetworkError, TransactionDoesNotExist, \
+    RECONCILED_REQUESTS, _error_code
+
+# answers that leave it unknown whether the gateway acted on the request
+_UNKNOWN_OUTCOME = (TimedOut, NetworkError)
+
+
+class Outbox(object):
+    """ Append-only log of money-moving calls and their outcomes.
+
+    Args:
+        path (str): the log file, created if missing
+
+    Optional Args:
+        sync (bool): fsync each batch so intents survive a power cut, not
+            just a crash of this process; defaults to True
+        requests (iterable): requestCodes to log, defaults to
+            RECONCILED_REQUESTS; only calls with an orderId are logged since
+            recovery looks them up by it
+    """
+
+    def __init__(self, path, sync=True, requests=RECONCILED_REQUESTS):
+        self.path = path
+        self.sync = sync
+        self.requests = frozenset(requests)
+
+        self._cond = threading.Condition()
+        self._pending = []
+        self._queued = 0
+        self._durable = 0
+        self._error = None
+        self._closed = False
+        self._file = None
+        self._flusher = None
+        # held while the file is written or swapped for a compacted one
+        self._io = threading.Lock()
+        self.batches = 0
+        self.records = 0
+
+    def wants(self, params):
+        return params.get('requestCode') in self.requests and \
+            bool(params.get('orderId'))
+
+    def track(self, merchant_id, params, func):
+        """ Log the intent of ``params``, run func() and log its outcome """
+
+        entry = uuid.uuid4().hex
+        self._append({
+            'id': entry,
+            'intent': params.get('requestCode'),
+            'merchant_id': merchant_id,
+            'order_id': params.get('orderId'),
+            'amount': params.get('amount'),
+            'market_segment_code': params.get('marketSegmentCode', 'I'),
+            'time': time.time(),
+        }, wait=True)
+
+        try:
+            receipt = func()
+        except _UNKNOWN_OUTCOME:
+            # left open for recover()
+            raise
+        except Error as e:
+            self._append({'id': entry, 'status': 'failed',
+                'error': _error_code(e)})
+            raise
+        self._append({'id': entry, 'status': 'completed',
+            'transaction_id': receipt.get('TRANSACTION_ID')})
+        return receipt
+
+    def _append(self, record, wait=False):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._cond:
+            if self._error is not None:
+                raise Error('Outbox %s is unusable: %s' % (self.path,
+                    self._error))
+            if self._closed:
+                raise Error('Outbox %s is closed' % self.path)
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop,
+                    name='salt-outbox')
+                self._flusher.daemon = True
+                self._flusher.start()
+
+            self._pending.append(line)
+            self._queued += 1
+            seq = self._queued
+            self._cond.notify_all()
+
+            if wait:
+                while self._durable < seq and self._error is None:
+                    self._cond.wait()
+                if self._durable < seq:
+                    raise Error('Unable to write to outbox %s: %s' % (
+                        self.path, self._error))
+
+    def _flush_loop(self):
+        # one writer: whatever piles up while a batch is being synced goes
+        # out together in the next one
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                batch, self._pending = self._pending, []
+                upto = self._queued
+
+            try:
+                with self._io:
+                    if self._file is None:
+                        self._file = self._open()
+                    self._file.write(''.join(batch))
+                    self._file.flush()
+                    if self.sync:
+                        os.fsync(self._file.fileno())
+            except (OSError, ValueError) as e:
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                return
+
+            with self._cond:
+                self._durable = upto
+                self.batches += 1
+                self.records += len(batch)
+                self._cond.notify_all()
+
+    def _open(self):
+        f = open(self.path, 'a+')
+        # a crash mid-write can leave a torn last line; end it, or the
+        # next record would be glued onto it and lost with it
+        if f.tell():
+            f.seek(f.tell() - 1)
+            if f.read(1) != '\n':
+                f.write('\n')
+        return f
+
+    def flush(self):
+        """ Wait until everything appended so far is written """
+
+        with self._cond:
+            seq = self._queued
+            while self._durable < seq and self._error is None:
+                self._cond.wait()
+
+    def close(self):
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._flusher is not None:
+            self._flusher.join()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def unresolved(self):
+        """ Intents logged without an outcome, oldest first """
+        return self._read()[0]
+
+    def _read(self):
+        self.flush()
+        if not os.path.exists(self.path):
+            return [], 0
+
+        entries = {}
+        with open(self.path) as f:
+            for line in iter(f.readline, ''):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn last line from a crash mid-write
+                    continue
+                if 'intent' in record:
+                    entries[record['id']] = record
+                else:
+                    entries.pop(record['id'], None)
+            offset = f.tell()
+        return sorted(entries.values(), key=lambda entry: entry['time']), \
+            offset
+
+    def recover(self, client):
+        """ Settle every unresolved entry with transaction_verification and
+        compact the log down to what is still open.
+
+        Args:
+            client (Salt or SaltPool): the client, or pool of clients by
+                merchant, to verify through
+
+        Returns a list with a dict per entry, the logged intent plus a
+        'status' of:
+            completed: the gateway has the order, see 'transaction_id'
+            not_found: the gateway never got it, it may be sent again
+            unresolved: still unknown ('error' says why), kept in the log
+        """
+
+        results = []
+        still_open = []
+        entries, offset = self._read()
+        for entry in entries:
+            result = dict(entry)
+            merchant_id = entry['merchant_id']
+            try:
+                if getattr(client, 'merchant_id', merchant_id) != merchant_id:
+                    raise Error('No client for merchant %s' % merchant_id)
+                salt = client if hasattr(client, 'merchant_id') else \
+                    client[merchant_id]
+                receipt = salt.transaction_verification(None,
+                    transaction_order_id=entry['order_id'],
+                    market_segment_code=entry['market_segment_code'])
+            except TransactionDoesNotExist:
+                result['status'] = 'not_found'
+            except Error as e:
+                result['status'] = 'unresolved'
+                result['error'] = _error_code(e)
+                still_open.append(entry)
+            else:
+                result['status'] = 'completed'
+                result['transaction_id'] = receipt.get('TRANSACTION_ID')
+            results.append(result)
+
+        self._rewrite(still_open, offset)
+        return results
+
+    def _rewrite(self, entries, offset):
+        if not os.path.exists(self.path):
+            return
+        with self._io:
+            # calls made while recovering appended past ``offset``; keep
+            # their records after the entries still open
+            with open(self.path) as f:
+                f.seek(offset)
+                tail = f.read()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.writelines(json.dumps(entry, separators=(',', ':')) + '\n'
+                    for entry in entries)
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
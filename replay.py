@@ -0,0 +1,352 @@
+""" Record gateway traffic and replay it against a local stand-in
+
+    salt = Salt(apikey, merchant_id,
+        transport=RecordingTransport('traffic.jsonl.gz'))
+    ...  # production or staging calls
+    salt.transport.close()
+
+    summary = Replay('traffic.jsonl.gz', speed=10).run()
+
+RecordingTransport wraps the transport a client would otherwise use and
+appends one JSON line per request: when it started relative to the
+recording, its latency, the request params and status and reply, with the
+credentials dropped and card data masked as in the logs. A path ending in
+.gz is compressed.
+
+Replay sends every recorded request again, rebuilt through its Operation,
+at the recorded pace times ``speed`` (or as fast as possible), through a
+client whose ReplayTransport answers with the recorded replies. What is
+measured is then the client's own work: building params, encoding,
+parsing replies, mapping errors. Each outcome is compared with the
+recorded one, so a change in how replies are interpreted shows up as a
+mismatch.
+
+    python -m <package>.replay traffic.jsonl.gz --speed 0
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import gzip
+import json
+import threading
+import time
+from urllib.parse import parse_qsl
+
+from . import api
+from .api import Error, ERROR_MAP, Operation, RESPONSE_ENCODING, \
+    RequestsTransport, Transport, TransportResponse, parse_response, \
+    redact_params, redact_text, _error_code
+
+# attached by the client on every call, so neither recorded nor matched on
+_CREDENTIALS = ('apiToken', 'merchantId')
+
+# card params as sent, to the keyword arguments _add_card reads them from
+_CARD_ARGS = {
+    'creditCardNumber': 'credit_card_number',
+    'expiryDate': 'expiry_date',
+    'storageTokenId': 'storage_token_id',
+}
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't')
+    return open(path, mode)
+
+def _key(params):
+    return tuple(sorted((name, value) for name, value in params.items()
+        if name not in _CREDENTIALS))
+
+def read_log(path):
+    """ Yield the entries of a recording, oldest first """
+
+    with _open(path, 'r') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # torn last line from a crash mid-write
+                continue
+
+
+class RecordingTransport(Transport):
+    """ Transport recording each request and reply it passes on.
+
+    Args:
+        path (str): the log, appended to; compressed if it ends in .gz
+
+    Optional Args:
+        transport (Transport): where requests really go, defaults to a new
+            RequestsTransport
+    """
+
+    def __init__(self, path, transport=None):
+        self.path = path
+        self.transport = transport if transport is not None else \
+            RequestsTransport()
+        self.records = 0
+        self._file = None
+        self._start = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        return getattr(self.transport, 'session', None)
+
+    def post(self, url, body, headers, timeout=None):
+        start = time.time()
+        try:
+            response = self.transport.post(url, body, headers, timeout)
+        except Error as e:
+            self._record(start, body, error=_error_code(e))
+            raise
+        self._record(start, body, response=response)
+        return response
+
+    def _record(self, start, body, response=None, error=None):
+        elapsed = time.time() - start
+        params = redact_params(dict(parse_qsl(body.decode('ascii'),
+            keep_blank_values=True)))
+        for name in _CREDENTIALS:
+            params.pop(name, None)
+
+        entry = {'ms': round(elapsed * 1000, 2), 'q': params}
+        if error is not None:
+            entry['e'] = error
+        else:
+            entry['s'] = response.status_code
+            entry['r'] = redact_text(response.content)
+
+        with self._lock:
+            if self._file is None:
+                self._file = _open(self.path, 'a')
+                self._start = start
+            entry['t'] = round(start - self._start, 4)
+            self._file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            self.records += 1
+
+    def ensure_pool_size(self, url, size):
+        self.transport.ensure_pool_size(url, size)
+
+    def warm(self, url, connections=1):
+        return self.transport.warm(url, connections)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        self.transport.close()
+
+
+class ReplayTransport(Transport):
+    """ Stand-in gateway answering each request with the reply recorded for
+    the same params, in recorded order; a request recorded more times than
+    it is replayed starts over from its first reply.
+
+    Args:
+        entries (iterable): entries of a recording, see read_log()
+
+    Optional Args:
+        latency (float): sleep this share of each recorded latency before
+            answering, 0 (the default) answers at once
+    """
+
+    def __init__(self, entries, latency=0.0):
+        self.latency = latency
+        self._replies = collections.defaultdict(list)
+        self._next = collections.Counter()
+        self._lock = threading.Lock()
+        for entry in entries:
+            self._replies[_key(entry['q'])].append(entry)
+
+    def post(self, url, body, headers, timeout=None):
+        key = _key(dict(parse_qsl(body.decode('ascii'),
+            keep_blank_values=True)))
+        replies = self._replies.get(key)
+        if not replies:
+            raise Error('No recorded reply for %s' % dict(key))
+        with self._lock:
+            entry = replies[self._next[key] % len(replies)]
+            self._next[key] += 1
+
+        if self.latency:
+            time.sleep(entry['ms'] / 1000.0 * self.latency)
+        error = entry.get('e')
+        if error is not None:
+            raise ERROR_MAP.get(error, Error)(error)
+        return TransportResponse(entry['s'],
+            entry['r'].encode(RESPONSE_ENCODING), ('127.0.0.1', 0),
+            len(body), True)
+
+
+_OPERATIONS = [value for value in vars(api).values()
+    if isinstance(value, Operation)]
+
+def _fixed_match(operation, params):
+    return all(params.get(name) == str(value) or params.get(name) == value
+        for name, value in operation._fixed.items())
+
+def _uncovered(operation, params):
+    """ Recorded params the Operation can't have sent """
+
+    names = set(operation._fixed)
+    names.update(name for arg, name, default, validator in operation._params)
+    if operation._card:
+        names.update(_CARD_ARGS)
+    return len(set(params) - names)
+
+def _operation(params):
+    # several Operations can share the fixed params of a request: a plan
+    # update may carry the state code that hold/resume/cancel send as a
+    # constant. The one whose Params explain every recorded param wins,
+    # and of those the one sending the fewest params of its own
+    candidates = [operation for operation in _OPERATIONS
+        if _fixed_match(operation, params)]
+    if not candidates:
+        raise Error('No Operation for requestCode %r' %
+            params.get('requestCode'))
+    return min(candidates, key=lambda operation: (
+        _uncovered(operation, params), -len(operation._fixed)))
+
+def _kwargs(operation, params):
+    kwargs = dict((arg, params[name]) for arg, name, default, validator in
+        operation._params if name in params)
+    if operation._card:
+        for name, arg in _CARD_ARGS.items():
+            if name in params:
+                kwargs[arg] = params[name]
+    return kwargs
+
+
+class Replay(object):
+    """ Play a recording back through a client.
+
+    Args:
+        entries (str or iterable): path of the recording, or its entries
+
+    Optional Args:
+        client (Salt): client to replay through, by default one over a
+            ReplayTransport of the recording; pass one over StubGateway or
+            a staging endpoint to replay against that instead
+        speed (float): pace relative to the recording, 10 replays ten times
+            faster; 0 or None sends as fast as possible. Defaults to 1
+        max_in_flight (int): calls at once, defaults to 20
+        latency (float): for the default client, share of the recorded
+            latencies its ReplayTransport sleeps for, defaults to 0
+    """
+
+    def __init__(self, entries, client=None, speed=1.0, max_in_flight=20,
+        latency=0.0):
+        if isinstance(entries, str):
+            entries = read_log(entries)
+        self.entries = sorted(entries, key=lambda entry: entry['t'])
+        if client is None:
+            client = api.Salt('replay', 'replay', url='http://replay.invalid/',
+                transport=ReplayTransport(self.entries, latency),
+                validate=False)
+        self.client = client
+        self.speed = speed
+        self.max_in_flight = max_in_flight
+
+        self.latencies = []
+        self.errors = 0
+        self.mismatches = []
+        self.elapsed = None
+
+    def _play(self, entry):
+        params = entry['q']
+        operation = _operation(params)
+        start = time.perf_counter()
+        try:
+            # masked card numbers would fail local validation
+            self.client.call(operation.build(_kwargs(operation, params),
+                False))
+            outcome = None
+        except Error as e:
+            outcome = _error_code(e)
+        return entry, outcome, time.perf_counter() - start
+
+    def _expected(self, entry):
+        # the outcome the recorded reply stands for, as _error_code() names
+        # it, independently of how the client under test reads replies
+        if 'e' in entry:
+            return entry['e']
+        message = parse_response(entry['r']).get('ERROR_MESSAGE')
+        if entry['s'] == 200 and message == 'SUCCESS':
+            return None
+        return message if message in ERROR_MAP else 'Error'
+
+    def run(self):
+        """ Replay every entry, returning the summary() at the end """
+
+        speed = self.speed
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(self.max_in_flight) as pool:
+            futures = []
+            for entry in self.entries:
+                if speed:
+                    delay = start + entry['t'] / speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                futures.append(pool.submit(self._play, entry))
+
+            for future in futures:
+                entry, outcome, elapsed = future.result()
+                self.latencies.append(elapsed)
+                if outcome is not None:
+                    self.errors += 1
+                expected = self._expected(entry)
+                if outcome != expected:
+                    self.mismatches.append((entry, expected, outcome))
+        self.elapsed = time.time() - start
+        return self.summary()
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(q):
+            if not latencies:
+                return None
+            return latencies[min(int(q * len(latencies)),
+                len(latencies) - 1)]
+
+        return {
+            'calls': len(latencies),
+            'errors': self.errors,
+            'mismatches': len(self.mismatches),
+            'elapsed': self.elapsed,
+            'rate': len(latencies) / self.elapsed if self.elapsed else 0.0,
+            'mean_us': sum(latencies) / len(latencies) * 1e6
+                if latencies else None,
+            'p50_us': percentile(0.5) * 1e6 if latencies else None,
+            'p99_us': percentile(0.99) * 1e6 if latencies else None,
+        }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a recording of '
+        'gateway traffic against a local stand-in')
+    parser.add_argument('log')
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+        help='pace relative to the recording, 0 for as fast as possible')
+    parser.add_argument('-c', '--concurrency', type=int, default=20,
+        help='calls in flight at once')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+        help='share of the recorded latencies the stand-in waits for')
+    args = parser.parse_args(argv)
+
+    replay = Replay(args.log, speed=args.speed,
+        max_in_flight=args.concurrency, latency=args.latency)
+    summary = replay.run()
+    for name in ('calls', 'errors', 'mismatches', 'elapsed', 'rate',
+        'mean_us', 'p50_us', 'p99_us'):
+        value = summary[name]
+        print('%-12s %s' % (name, '%.1f' % value
+            if isinstance(value, float) else value))
+    for entry, expected, outcome in replay.mismatches[:10]:
+        print('mismatch at %.3fs (%s): recorded %s, replayed %s' % (
+            entry['t'], entry['q'].get('requestCode'), expected, outcome))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,393 @@
+""" A local stand-in for the SALT gateway, for load tests and benchmarks
+
+Answers every requestCode the client sends with key=value bodies shaped like
+the real gateway's, keeps connections alive, and can add latency and inject
+any ERROR_MAP error:
+
+    gateway = StubGateway(latency=latency_distribution('lognormal', 0.05),
+        errors={'C001_TIMED_OUT': 0.01})
+    gateway.start()
+    salt = Salt(apikey, merchant_id, url=gateway.url)
+
+or in-process, with no HTTP at all:
+
+    salt = Salt(apikey, merchant_id,
+        transport=InMemoryTransport(StubGateway().respond))
+
+Or standalone, from the directory containing this package:
+
+    python -m <package>.stub --port 8080 --latency lognormal:0.05 \\
+        --error C002_SYSTEM_ERROR=0.01
+"""
+
+import argparse
+import itertools
+import math
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+from .api import ERROR_MAP
+
+def latency_distribution(kind, *params):
+    """ Return a callable drawing response delays in seconds.
+
+    Args:
+        kind (str): one of
+            fixed(seconds)
+            uniform(low, high)
+            exponential(mean)
+            lognormal(median, sigma=0.5): a long right tail, like real
+                gateway latency
+        params (float): the parameters listed above
+    """
+
+    if kind == 'fixed':
+        seconds, = params
+        return lambda: seconds
+    if kind == 'uniform':
+        low, high = params
+        return lambda: random.uniform(low, high)
+    if kind == 'exponential':
+        mean, = params
+        return lambda: random.expovariate(1.0 / mean)
+    if kind == 'lognormal':
+        median = params[0]
+        sigma = params[1] if len(params) > 1 else 0.5
+        mu = math.log(median)
+        return lambda: random.lognormvariate(mu, sigma)
+    raise ValueError('Unknown latency distribution %r' % kind)
+
+class StubState(object):
+    """ The little gateway state the stub needs to give consistent answers:
+    transactions by ID and order ID, storage profiles, recurring orders
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.transaction_ids = itertools.count(10000000)
+        self.transactions = {}
+        self.orders = {}
+        self.storage = {}
+        self.recurring = {}
+        # purchases of the current batch can be voided, those of closed
+        # batches refunded
+        self.batch = 1
+        self.batches = {}
+        self.refunded = {}
+
+    def record(self, params, amount):
+        with self.lock:
+            transaction_id = str(next(self.transaction_ids))
+            transaction = {
+                'TRANSACTION_ID': transaction_id,
+                'ORDER_ID': params.get('orderId', ''),
+                'AMOUNT': str(amount),
+            }
+            self.transactions[transaction_id] = transaction
+            self.batches[transaction_id] = self.batch
+            if params.get('orderId'):
+                self.orders[params['orderId']] = transaction
+            return transaction
+
+def _approved(state, params):
+    transaction = state.record(params, params.get('amount', 0))
+    return [
+        ('APPROVED', 'true'),
+        ('TRANSACTION_ID', transaction['TRANSACTION_ID']),
+        ('ORDER_ID', transaction['ORDER_ID']),
+        ('APPROVAL_CODE', 'T%05d' % (int(transaction['TRANSACTION_ID'])
+            % 100000)),
+        ('AMOUNT', transaction['AMOUNT']),
+        ('APPROVED_AMOUNT', transaction['AMOUNT']),
+        ('AVS_RESPONSE_CODE', 'Y'),
+        ('CVV2_RESPONSE_CODE', 'M'),
+        ('RESPONSE_CODE', '1'),
+        ('MESSAGE', 'APPROVED'),
+    ]
+
+def _verify(state, params):
+    with state.lock:
+        transaction = state.transactions.get(params.get('transactionId')) or \
+            state.orders.get(params.get('transactionOrderId'))
+    if transaction is None:
+        return 'C111_TRANSACTION_DOES_NOT_EXIST'
+    return [('APPROVED', 'true')] + sorted(transaction.items())
+
+def _verify_card(state, params):
+    return [('APPROVED', 'true'), ('AVS_RESPONSE_CODE', 'Y'),
+        ('CVV2_RESPONSE_CODE', 'M')]
+
+def _batch(state, params):
+    with state.lock:
+        state.batch += 1
+    return [('BATCH_ID', str(int(time.time())))]
+
+def _void(state, params):
+    transaction_id = params.get('transactionId', '')
+    with state.lock:
+        batch = state.batches.get(transaction_id)
+        if batch is None:
+            return 'C103_INVALID_TRANSACTION'
+        if batch != state.batch:
+            return 'C106_TRANSACTION_NOT_VOIDABLE'
+        # voided purchases are never settled, so never refundable
+        state.batches[transaction_id] = None
+    return [('TRANSACTION_ID', transaction_id)]
+
+def _refund(state, params):
+    transaction_id = params.get('transactionId', '')
+    with state.lock:
+        if transaction_id not in state.batches:
+            return 'C103_INVALID_TRANSACTION'
+        batch = state.batches[transaction_id]
+        if batch is None or batch == state.batch:
+            return 'C104_PURCHASE_NOT_IN_REFUNDABLE_STATE'
+        amount = int(params.get('amount') or 0)
+        refunded = state.refunded.get(transaction_id, 0) + amount
+        if refunded > int(state.transactions[transaction_id]['AMOUNT']):
+            return 'C105_PURCHASE_REFUND_AMOUNT_OVER_LIMIT'
+        state.refunded[transaction_id] = refunded
+    return _approved(state, params)
+
+def _fraud(state, params):
+    return [('TRANSACTION_ID', params.get('transactionId', '')),
+        ('FRAUD_SESSION_ID', params.get('fraudSessionId', ''))]
+
+def _storage(state, params):
+    token = params.get('storageTokenId')
+    operation = params.get('operationCode')
+    with state.lock:
+        if operation == 'create':
+            if token in state.storage:
+                return 'C300_STORAGE_TOKEN_ID_ALREADY_IN_USE'
+            state.storage[token] = params
+        elif token not in state.storage:
+            return 'C301_STORAGE_RECORD_DOES_NOT_EXIST'
+        elif operation == 'update':
+            state.storage[token] = params
+        elif operation == 'delete':
+            del state.storage[token]
+            return [('STORAGE_TOKEN_ID', token)]
+        profile = state.storage[token]
+
+    number = profile.get('creditCardNumber') or ''
+    return [
+        ('STORAGE_TOKEN_ID', token),
+        ('CREDIT_CARD_NUMBER', '*' * max(len(number) - 4, 0) + number[-4:]),
+        ('EXPIRY_DATE', profile.get('expiryDate', '')),
+    ]
+
+def _recurring(state, params):
+    order_id = params.get('orderId')
+    operation = params.get('operationCode')
+    with state.lock:
+        if operation == 'create':
+            state.recurring[order_id] = params
+        elif order_id not in state.recurring:
+            return 'C102_INVALID_PURCHASE'
+        elif operation == 'update':
+            state.recurring[order_id].update(params)
+        plan = state.recurring[order_id]
+
+    if operation == 'execute':
+        if plan.get('periodicPurchaseStateCode') in ('3', '4'):
+            return 'C112_PERIODIC_PURCHASE_COMPLETE_OR_CANCELLED'
+        return _approved(state, dict(params, amount=plan.get('amount', 0)))
+    return [
+        ('ORDER_ID', order_id),
+        ('PERIODIC_PURCHASE_STATE_CODE',
+            plan.get('periodicPurchaseStateCode', '1')),
+    ]
+
+# how the stub answers each requestCode used by the client
+HANDLERS = {
+    'singlePurchase': _approved,
+    'void': _void,
+    'refund': _refund,
+    'verifyTransaction': _verify,
+    'verifyCreditCard': _verify_card,
+    'batch': _batch,
+    'fraudUpdate': _fraud,
+    'secureStorage': _storage,
+    'recurringPurchase': _recurring,
+}
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 drops connects from a concurrent client and
+    # the kernel's 1s SYN retry then shows up as p99 latency
+    request_queue_size = 1024
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes; with Nagle on, the body
+    # waits for the client's delayed ACK and every call gains ~40ms
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        gateway = self.server.gateway
+        length = int(self.headers.get('Content-Length') or 0)
+        params = dict(parse_qsl(self.rfile.read(length).decode('latin-1'),
+            keep_blank_values=True))
+
+        body = gateway.respond(params)
+        delay = gateway.latency() if gateway.latency else 0
+        if delay > 0:
+            time.sleep(delay)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubGateway(object):
+    """ Threaded HTTP/1.1 server speaking the gateway's protocol.
+
+    Optional Args:
+        host (str): defaults to 127.0.0.1
+        port (int): defaults to 0, any free port
+        latency (callable): returns the delay in seconds before each answer,
+            see latency_distribution
+        errors (dict): ERROR_MAP code to the probability of answering any
+            request with it
+        credentials (tuple): (apiToken, merchantId) to accept, any by default
+        max_rate (int): requests per merchant per second to accept before
+            answering C107_REQUEST_DENIED, unlimited by default
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=None, errors=None,
+        credentials=None, max_rate=None):
+        for code in errors or {}:
+            if code not in ERROR_MAP:
+                raise ValueError('Unknown error code %r' % code)
+
+        self.latency = latency
+        self.errors = sorted((errors or {}).items())
+        self.credentials = credentials
+        self.max_rate = max_rate
+        self.state = StubState()
+        self.requests = 0
+        self.denied = 0
+        self._window = None
+        self._window_counts = {}
+        self._rate_lock = threading.Lock()
+        self.server = _Server((host, port), _Handler)
+        self.server.gateway = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d/gateway/creditcard/processor.do' % (host, port)
+
+    def answer(self, params):
+        """ Return the (key, value) pairs answering a request """
+
+        # handler threads answer concurrently
+        with self.state.lock:
+            self.requests += 1
+        if self.credentials is not None and self.credentials != (
+            params.get('apiToken'), params.get('merchantId')):
+            return [('ERROR_MESSAGE', 'C100_INVALID_MERCHANT_CREDENTIALS')]
+
+        if self.max_rate is not None and not self._admit(
+            params.get('merchantId')):
+            return [('ERROR_MESSAGE', 'C107_REQUEST_DENIED')]
+
+        roll = random.random()
+        for code, probability in self.errors:
+            if roll < probability:
+                return [('ERROR_MESSAGE', code)]
+            roll -= probability
+
+        handler = HANDLERS.get(params.get('requestCode'))
+        if handler is None:
+            return [('ERROR_MESSAGE', 'C004_VALIDATION_ERROR')]
+
+        fields = handler(self.state, params)
+        if isinstance(fields, str):
+            return [('ERROR_MESSAGE', fields)]
+        return [('ERROR_MESSAGE', 'SUCCESS')] + fields
+
+    def respond(self, params):
+        """ The reply body to a request, as sent over the wire. Pass this to
+        an InMemoryTransport to run the stub without HTTP or latency.
+        """
+
+        return ''.join('%s=%s\n' % pair
+            for pair in self.answer(params)).encode('latin-1')
+
+    def _admit(self, merchant_id):
+        # fixed one-second windows, counted per merchant
+        with self._rate_lock:
+            window = int(time.time())
+            if window != self._window:
+                self._window = window
+                self._window_counts = {}
+            count = self._window_counts.get(merchant_id, 0) + 1
+            self._window_counts[merchant_id] = count
+            if count > self.max_rate:
+                self.denied += 1
+                return False
+            return True
+
+    def start(self):
+        """ Serve from a background thread """
+
+        self._thread = threading.Thread(target=self.server.serve_forever,
+            name='salt-stub-gateway')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', default=None,
+        help='distribution:params, e.g. fixed:0.05 or lognormal:0.05,0.5')
+    parser.add_argument('--error', action='append', default=[],
+        help='CODE=probability, may be repeated')
+    parser.add_argument('--max-rate', type=int, default=None,
+        help='requests per merchant per second before C107_REQUEST_DENIED')
+    args = parser.parse_args(argv)
+
+    latency = None
+    if args.latency:
+        kind, _, params = args.latency.partition(':')
+        latency = latency_distribution(kind,
+            *[float(p) for p in params.split(',') if p])
+
+    errors = {}
+    for spec in args.error:
+        code, _, probability = spec.partition('=')
+        errors[code] = float(probability)
+
+    gateway = StubGateway(args.host, args.port, latency, errors,
+        max_rate=args.max_rate)
+    print('Stub gateway listening on %s' % gateway.url)
+    try:
+        gateway.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()